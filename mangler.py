@@ -61,6 +61,28 @@ def main():
 	# 	default=False,
 	# 	help="Generate PAR2 files in the background if they don't exist already.",
 	# )
+	parser.add_option('-P', '--processes',
+		dest='processes',
+		type='int',
+		help='Split the articles between N posting processes, each with a share of the connections',
+		metavar='N',
+	)
+	parser.add_option('--coordinator',
+		dest='coordinator',
+		help='Hand the articles out to workers that connect to ADDRESS (host:port) instead of posting them',
+		metavar='ADDRESS',
+	)
+	parser.add_option('--worker',
+		dest='worker',
+		help='Post articles for the coordinator at ADDRESS (host:port), no files needed',
+		metavar='ADDRESS',
+	)
+	parser.add_option('-r', '--resume',
+		dest='resume',
+		action='store_true',
+		default=False,
+		help="Skip articles that were already posted according to the post's journal",
+	)
 	parser.add_option('-d', '--debug',
 		dest='debug',
 		action='store_true',
@@ -76,8 +98,8 @@ def main():
 
 	(options, args) = parser.parse_args()
 	
-	# No args? We have nothing to do!
-	if not args:
+	# No args? We have nothing to do! Workers get told what to post.
+	if not args and not options.worker:
 		parser.print_help()
 		sys.exit(1)
 	
@@ -98,7 +120,7 @@ def main():
 			else:
 				print 'ERROR: "%s" does not exist or is not a file!' % (arg)
 	
-	if not postme:
+	if not postme and not options.worker:
 		print 'ERROR: no valid arguments provided on command line!'
 		sys.exit(1)
 	
@@ -124,13 +146,19 @@ def main():
 	for c in (' \t'):
 		newsgroup = newsgroup.replace(c, '')
 	
+	if options.processes:
+		conf['posting']['processes'] = options.processes
+	
 	# And off we go
-	poster = PostMangler(conf, options.debug)
+	poster = PostMangler(conf, options.debug, options.resume, options.config)
+	
+	if options.worker:
+		poster.work(options.worker)
 	
-	if options.profile:
+	elif options.profile:
 		import hotshot
 		prof = hotshot.Profile('profile.poster')
-		prof.runcall(poster.post, newsgroup, postme, post_title=post_title)
+		prof.runcall(poster.post, newsgroup, postme, post_title=post_title, coordinate=options.coordinator)
 		prof.close()
 		
 		import hotshot.stats
@@ -140,7 +168,7 @@ def main():
 		stats.print_stats(25)
 	
 	else:
-		poster.post(newsgroup, postme, post_title=post_title)
+		poster.post(newsgroup, postme, post_title=post_title, coordinate=options.coordinator)
 
 # ---------------------------------------------------------------------------
 
@@ -25,15 +25,49 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import time
+
+from array import array
+from email.utils import formatdate
+
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
-from cStringIO import StringIO
 
-from newsmangler.yenc import yEncode
+from newsmangler.filewrap import ReadPart
+from newsmangler.yenc import yEncBound, yEncodeInto
+
+# ---------------------------------------------------------------------------
+# Encode data for part partnum. Returns the encoded data, as a view of the
+# buffer it was encoded into, and the =yend trailer.
+def EncodeData(data, partnum):
+	body = bytearray(yEncBound(data))
+	end, partcrc = yEncodeInto(body, data)
+	
+	# yEnc end, and done writing for now
+	tail = '=yend size=%d part=%d pcrc32=%s\r\n.\r\n' % (len(data), partnum, partcrc)
+	
+	return memoryview(body)[:end], tail
+
+# The same thing for the encoding pool, which reads the data itself. Worker
+# processes want to send back a string, bytearrays and memoryviews don't
+# pickle well.
+def EncodePart(filepath, begin, end, partnum, read_mode='read', as_string=False):
+	data = ReadPart(filepath, begin, end, read_mode)
+	body, tail = EncodeData(data, partnum)
+	if as_string:
+		body = body.tobytes()
+	return body, tail
+
+# ---------------------------------------------------------------------------
+
+class Article(object):
+	# There's only ever a few of these around at once, but they might as well
+	# be small
+	__slots__ = ('_filewrap', '_begin', '_end', '_fileinfo', '_subject', '_partnum',
+		'headers', 'buffers', 'size', 'attempts', '__body', '__tail')
 
-class Article:
 	def __init__(self, filewrap, begin, end, fileinfo, subject, partnum):
 		self._filewrap = filewrap
 		self._begin = begin
@@ -43,41 +77,175 @@ class Article:
 		self._partnum = partnum
 		
 		self.headers = OrderedDict()
-		self.postfile = StringIO()
+		
+		# The article as a list of buffers, ready for sending
+		self.buffers = None
+		self.size = 0
+		self.attempts = 0
+		self.__body = None
+		self.__tail = None
 
-		self.__article_size = 0
+	# Read and encode our data. This is the expensive bit, so PostMangler does
+	# it ahead of time.
+	def encode(self):
+		if self.__body is not None:
+			return
+		
+		# A retry that has been released has to be read again by itself, the
+		# FileWrap has already finished with this part
+		if self.attempts:
+			self.encoded(EncodeData(self._filewrap.reread(self._begin, self._end), self._partnum))
+			return
+		
+		data = self._filewrap.read_part(self._begin, self._end)
+		try:
+			self.encoded(EncodeData(data, self._partnum))
+		finally:
+			self._filewrap.done_part(data)
 
-	def prepare(self):
-		# Don't prepare again if we already did everything
-		if self.__article_size > 0:
-			self.postfile.seek(0, 0)
-			return self.__article_size
+	# Arguments for EncodePart(), to have this article encoded somewhere else
+	def encode_args(self, as_string=False):
+		return (self._fileinfo['filepath'], self._begin, self._end, self._partnum, self._filewrap.read_mode, as_string)
+
+	# Keep the result of EncodeData() or EncodePart()
+	def encoded(self, result):
+		self.__body, self.__tail = result
+	
+	def is_encoded(self):
+		return self.__body is not None
 
-		# Headers
-		for k, v in self.headers.items():
-			self.postfile.write('%s: %s\r\n' % (k, v))
+	# Put the article together. A retry might have a new Message-ID, so this
+	# is done every time, it's only the encoding that we want to keep. Servers
+	# taking articles with TAKETHIS want a Date like any other relayed article.
+	def prepare(self):
+		self.encode()
 		
-		self.postfile.write('\r\n')
+		self.headers['Date'] = formatdate(usegmt=True)
 		
-		# yEnc start
-		line = '=ybegin part=%d total=%d line=128 size=%d name=%s\r\n' % (
-			self._partnum, self._fileinfo['parts'], self._fileinfo['filesize'], self._fileinfo['filename']
+		# Our own headers, then the ones shared by every article
+		head = ''.join(['%s: %s\r\n' % (k, v) for k, v in self.headers.items()])
+		
+		# yEnc start, the end of the =ybegin line is the same for every part
+		ystart = '=ybegin part=%d%s=ypart begin=%d end=%d\r\n' % (
+			self._partnum, self._fileinfo['ybegin'], self._begin + 1, self._end,
 		)
-		self.postfile.write(line)
-		line = '=ypart begin=%d end=%d\r\n' % (self._begin + 1, self._end)
-		self.postfile.write(line)
 		
-		# yEnc data
-		data = self._filewrap.read_part(self._begin, self._end)
-		partcrc = yEncode(self.postfile, data)
+		self.buffers = [head, self._fileinfo['headers'], ystart, self.__body, self.__tail]
+		self.size = sum([len(b) for b in self.buffers])
 
-		# yEnc end
-		line = '=yend size=%d part=%d pcrc32=%s\r\n' % (self._end - self._begin, self._partnum, partcrc)
-		self.postfile.write(line)
-		
-		# And done writing for now
-		self.postfile.write('.\r\n')
-		self.__article_size = self.postfile.tell()
-		self.postfile.seek(0, 0)
+		return self.size
+
+	# Throw away the encoded article once we're done with it
+	def release(self):
+		self.buffers = None
+		self.__body = None
+		self.__tail = None
 
-		return self.__article_size
+# ---------------------------------------------------------------------------
+# The list of articles to post. Posting a few TB would mean millions of
+# Article objects, so this just keeps a file number and part number for each
+# one in a pair of arrays. Articles are built when someone looks at them, which
+# is only ever the first few.
+class ArticleTable:
+	def __init__(self, hostname):
+		self._hostname = hostname
+		
+		# (filewrap, fileinfo, subject) for each file
+		self._files = []
+		
+		# file number and part number of every article, we're up to _head
+		self._filenums = array('I')
+		self._partnums = array('I')
+		self._head = 0
+		
+		# Articles that have already been built, starting at _head
+		self._built = []
+	
+	def __len__(self):
+		return len(self._filenums) - self._head
+	
+	def __getitem__(self, i):
+		if i < 0 or i >= len(self):
+			raise IndexError('article index out of range')
+		
+		while len(self._built) <= i:
+			self._built.append(self._build(self._head + len(self._built)))
+		return self._built[i]
+	
+	# Add a file, returns the id to use for its parts
+	def add_file(self, filewrap, fileinfo, subject):
+		self._files.append((filewrap, fileinfo, subject))
+		return len(self._files) - 1
+	
+	# Add parts of a file
+	def add_parts(self, fileid, partnums):
+		self._filenums.extend(array('I', [fileid]) * len(partnums))
+		self._partnums.extend(partnums)
+	
+	# (filewrap, fileinfo, subject) for a file
+	def file(self, fileid):
+		return self._files[fileid]
+	
+	# ... and for every file, in order
+	def files(self):
+		return list(self._files)
+	
+	# Only keep every count'th article starting from index, for posting with
+	# more than one process
+	def shard(self, index, count):
+		self._filenums = self._filenums[self._head + index::count]
+		self._partnums = self._partnums[self._head + index::count]
+		self._head = 0
+		self._built = []
+		
+		# Each FileWrap closes its file after the last part it will see
+		parts = {}
+		for fileid in self._filenums:
+			parts[fileid] = parts.get(fileid, 0) + 1
+		for fileid, (filewrap, fileinfo, subject) in enumerate(self._files):
+			filewrap.set_parts(parts.get(fileid, 0))
+	
+	# (file number, part number) of every article left
+	def parts(self):
+		for i in xrange(self._head, len(self._filenums)):
+			yield (self._filenums[i], self._partnums[i])
+	
+	# Forget about every article, but not the files. Parts can be added again
+	# with add_parts().
+	def clear(self):
+		self._filenums = array('I')
+		self._partnums = array('I')
+		self._head = 0
+		self._built = []
+		for filewrap, fileinfo, subject in self._files:
+			filewrap.set_parts(0)
+	
+	# Remove the first article and return it
+	def popleft(self):
+		article = self[0]
+		del self._built[0]
+		self._head += 1
+		
+		# Throw away the start of the arrays every now and then
+		if self._head >= 65536 and self._head * 2 >= len(self._filenums):
+			del self._filenums[:self._head]
+			del self._partnums[:self._head]
+			self._head = 0
+		
+		return article
+	
+	def _build(self, i):
+		filewrap, fileinfo, subject = self._files[self._filenums[i]]
+		partnum = int(self._partnums[i])
+		
+		begin = (partnum - 1) * fileinfo['article_size']
+		end = min(fileinfo['filesize'], partnum * fileinfo['article_size'])
+		
+		art = Article(filewrap, begin, end, fileinfo, subject, partnum)
+		art.headers['Subject'] = subject % (partnum)
+		art.headers['Message-ID'] = self.new_msgid(partnum)
+		return art
+	
+	# Make up a Message-ID for a part
+	def new_msgid(self, partnum):
+		return '<%.5f.%d@%s>' % (time.time(), partnum, self._hostname)
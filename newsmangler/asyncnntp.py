@@ -25,9 +25,10 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-"A basic NNTP client using asyncore"
+"A basic NNTP client using asyncore, and a pool of connections to drive it"
 
 import asyncore
+import collections
 import errno
 import logging
 import re
@@ -35,6 +36,8 @@ import select
 import socket
 import time
 
+from newsmangler.common import NiceSize
+
 # ---------------------------------------------------------------------------
 
 STATE_DISCONNECTED = 0
@@ -47,39 +50,531 @@ MODE_POST_INIT = 2
 MODE_POST_DATA = 3
 MODE_POST_DONE = 4
 MODE_DATA = 5
-
-POST_BUFFER_MIN = 16384
-POST_READ_SIZE = 262144
+MODE_STREAM_INIT = 6
+MODE_STREAM = 7
 
 MSGID_RE = re.compile(r'(<\S+@\S+>)')
 
+# What a connection can get stuck waiting on, the option with how long to
+# wait, and what to call it when it does get stuck
+STALLS = {
+    'connect': ('connect_timeout', 'connecting'),
+    'login': ('connect_timeout', 'logging in'),
+    'post': ('reply_timeout', 'waiting for the server to accept POST'),
+    'send': ('send_timeout', 'sending article data'),
+    'reply': ('reply_timeout', 'waiting for the server to take an article'),
+}
+
 # ---------------------------------------------------------------------------
+# Splits incoming data into lines. Only the new data is searched for line
+# endings, anything left over is kept until the rest of the line turns up.
 
-class asyncNNTP(asyncore.dispatcher):
-    def __init__(self, parent, connid, host, port, bindto, username, password):
-        asyncore.dispatcher.__init__(self)
+class LineReader:
+    def __init__(self):
+        self._buf = ''
+    
+    # Add some data, returns any lines that are now complete
+    def feed(self, data):
+        # A CR at the end of the old data might go with an LF in the new data
+        pos = data.find('\r\n')
+        if self._buf:
+            if self._buf[-1] == '\r' and data[:1] == '\n':
+                pos = -1
+            data = self._buf + data
+            if pos >= 0:
+                pos += len(self._buf)
+            else:
+                pos = data.find('\r\n', len(self._buf) - 1)
         
+        lines = []
+        start = 0
+        while pos >= 0:
+            lines.append(data[start:pos])
+            start = pos + 2
+            pos = data.find('\r\n', start)
+        
+        self._buf = data[start:]
+        return lines
+
+# Split a response line into the numeric response code and the rest of the
+# line. Garbage gets a code of 0.
+def ParseResponse(line):
+    try:
+        return int(line[:3]), line[4:]
+    except ValueError:
+        return 0, line
+
+# ---------------------------------------------------------------------------
+# One server (or account) that we post to, and the connections to it. The
+# weight decides how much of the posting it gets when more than one server has
+# an idle connection.
+
+class Server:
+    def __init__(self, pool, name, conf):
+        self.logger = logging.getLogger('mangler')
+        
+        self.pool = pool
+        self.name = name
+        self.conf = conf
+        self.weight = float(conf['weight'])
+        
+        self.conns = []
+        self.controller = None
+        self.bucket = TokenBucket()
+        
+        # Article data sent to this server
+        self.bytes = 0
+        
+        # How many times a connection has failed or been closed on us
+        self.errors = 0
+        
+        # How many times a connection got stuck, by what it was waiting for
+        self.stalls = {}
+    
+    # Open count connections to the server
+    def connect(self, count):
+        for i in range(count):
+            self.add_connection()
+    
+    # Open one more connection
+    def add_connection(self):
+        conn = self.pool.new_connection(self)
+        conn.do_connect()
+        self.conns.append(conn)
+    
+    # Get rid of a connection. One that is waiting to reconnect or has nothing
+    # to do can go now, otherwise the one with the least left to do finishes
+    # that first.
+    def remove_connection(self):
+        conns = [conn for conn in self.conns if not conn.retiring]
+        if not conns:
+            return
+        
+        for conn in conns:
+            if conn.state == STATE_DISCONNECTED or (conn in self.pool.idle and not conn.in_flight()):
+                break
+        else:
+            conn = min(conns, key=lambda conn: conn.in_flight())
+        
+        conn.retiring = True
+        if conn in self.pool.idle:
+            self.pool.idle.remove(conn)
+        if conn.state == STATE_DISCONNECTED or not conn.in_flight():
+            self.drop_connection(conn)
+    
+    def drop_connection(self, conn):
+        self.logger.debug('%d: closing, not needed', conn.connid)
+        conn.close()
+        self.conns.remove(conn)
+        self.pool.conns.remove(conn)
+        self.pool.unthrottle_conn(conn)
+    
+    # Is a connection still getting ready to post?
+    def logging_in(self):
+        for conn in self.conns:
+            if conn.state != STATE_DISCONNECTED and conn.mode in (MODE_AUTH, MODE_STREAM_INIT):
+                return True
+        return False
+    
+    # How many connections we have, not counting ones on their way out
+    def active_count(self):
+        return len([conn for conn in self.conns if not conn.retiring])
+
+# ---------------------------------------------------------------------------
+# A pool of connections to one or more servers. It owns the poller and socket
+# map that the connections use, keeps track of which ones are idle, and runs
+# callbacks for any other file descriptors that want to be part of the same
+# loop.
+
+class ConnectionPool:
+    def __init__(self, parent, poller):
         self.logger = logging.getLogger('mangler')
         
         self.parent = parent
+        self.poller = poller
+        self.socket_map = {}
+        
+        self.servers = []
+        self.conns = []
+        self.idle = []
+        self._readers = {}
+        
+        self._next_id = 0
+        
+        # One bucket for everything, servers have their own as well. While
+        # any of them has a limit, connections that want to send take turns.
+        self.bucket = TokenBucket()
+        self.shaped = False
+        self._throttled = collections.deque()
+    
+    # Add a server and open count connections to it
+    def connect(self, name, conf, count):
+        server = Server(self, name, conf)
+        self.servers.append(server)
+        server.connect(count)
+        return server
+    
+    def new_connection(self, server):
+        conn = asyncNNTP(self, server, self._next_id)
+        self._next_id += 1
+        self.conns.append(conn)
+        return conn
+    
+    # Call callback when something can be read from fd
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self.poller.register(fd, select.POLLIN)
+    
+    def remove_reader(self, fd):
+        del self._readers[fd]
+        self.poller.unregister(fd)
+    
+    # -----------------------------------------------------------------------
+    # Connections tell us when they're ready for another article
+    def conn_idle(self, conn):
+        if conn.retiring:
+            if not conn.in_flight():
+                conn.server.drop_connection(conn)
+        else:
+            self.idle.append(conn)
+    
+    # A connection has gone away, it can't be idle any more
+    def conn_closed(self, conn):
+        if conn in self.idle:
+            self.idle.remove(conn)
+        self.unthrottle_conn(conn)
+        if conn.retiring:
+            conn.server.conns.remove(conn)
+            self.conns.remove(conn)
+        else:
+            conn.server.errors += 1
+    
+    # Get an idle connection, if there is one. With more than one server we
+    # pick the one that is furthest behind its share by weight.
+    def get_idle(self):
+        if not self.idle:
+            return None
+        
+        best = 0
+        if len(self.servers) > 1:
+            for i, conn in enumerate(self.idle):
+                if conn.server.bytes / conn.server.weight < self.idle[best].server.bytes / self.idle[best].server.weight:
+                    best = i
+        return self.idle.pop(best)
+    
+    # How many articles are waiting on the server
+    def in_flight(self):
+        return sum([conn.in_flight() for conn in self.conns])
+    
+    # -----------------------------------------------------------------------
+    # Reconnect anything that has waited long enough
+    def reconnect_check(self, now):
+        for conn in self.conns:
+            conn.reconnect_check(now)
+    
+    # Close anything that has been stuck for too long, it'll reconnect later.
+    # Waiting for our rate limit doesn't count.
+    def stall_check(self, now):
+        for conn in self.conns[:]:
+            if conn.deadline is not None and now >= conn.deadline and conn not in self._throttled:
+                conn.stalled()
+    
+    # How many times connections have got stuck
+    def stall_count(self):
+        return sum([sum(server.stalls.values()) for server in self.servers])
+    
+    # When we next need to do something without hearing from a socket, or None
+    def next_timeout(self):
+        wake_at = None
+        for conn in self.conns:
+            if conn.state == STATE_DISCONNECTED and (wake_at is None or conn.reconnect_at < wake_at):
+                wake_at = conn.reconnect_at
+        
+        # Something might get stuck
+        for conn in self.conns:
+            if conn.deadline is not None and conn not in self._throttled and \
+                (wake_at is None or conn.deadline < wake_at):
+                wake_at = conn.deadline
+        
+        # A connection waiting for its turn needs all of its buckets ready
+        for conn in self._throttled:
+            ready_at = max([bucket.ready_at() for bucket in self.buckets(conn)] or [0])
+            if wake_at is None or ready_at < wake_at:
+                wake_at = ready_at
+        return wake_at
+    
+    # -----------------------------------------------------------------------
+    # Limit how fast we send, in bytes a second. Without a server it's the
+    # limit for everything.
+    def set_rate(self, rate, server=None):
+        if server is None:
+            self.bucket.set_rate(rate)
+        else:
+            server.bucket.set_rate(rate)
+        
+        self.shaped = bool(self.bucket.rate or [s for s in self.servers if s.bucket.rate])
+        if not self.shaped:
+            self.unthrottle(time.time())
+    
+    # The buckets a connection has to take tokens from
+    def buckets(self, conn):
+        return [bucket for bucket in (self.bucket, conn.server.bucket) if bucket.rate]
+    
+    # How much a connection may send right now, 0 if it has to wait
+    def allowance(self, conn):
+        now = time.time()
+        allowed = QUANTUM
+        for bucket in self.buckets(conn):
+            bucket.refill(now)
+            if bucket.tokens < bucket.chunk:
+                return 0
+            allowed = min(allowed, int(bucket.tokens))
+        return allowed
+    
+    def spend(self, conn, sent):
+        for bucket in self.buckets(conn):
+            bucket.tokens -= sent
+    
+    # A connection has to wait for its turn. One that had to wait without
+    # sending anything goes back to the front of the line.
+    def throttle(self, conn, front=False):
+        self.poller.register(conn._fileno, select.POLLIN)
+        if conn not in self._throttled:
+            if front:
+                self._throttled.appendleft(conn)
+            else:
+                self._throttled.append(conn)
+    
+    def unthrottle_conn(self, conn):
+        if conn in self._throttled:
+            self._throttled.remove(conn)
+    
+    # Let connections write again, in order, while there are tokens for them
+    def unthrottle(self, now):
+        left = {}
+        for conn in list(self._throttled):
+            buckets = self.buckets(conn)
+            for bucket in buckets:
+                if bucket not in left:
+                    bucket.refill(now)
+                    left[bucket] = bucket.tokens
+                if left[bucket] < bucket.chunk:
+                    break
+            else:
+                for bucket in buckets:
+                    left[bucket] -= QUANTUM
+                self._throttled.remove(conn)
+                self.poller.register(conn._fileno)
+                conn.watch(True)
+    
+    # Poll our poll() object and do whatever is neccessary. Basically a
+    # combination of asyncore.poll2() and asyncore.readwrite(), without all the
+    # frippery.
+    def poll(self, timeout):
+        results = self.poller.poll(timeout)
+        if self._throttled:
+            self.unthrottle(time.time())
+        
+        for fd, flags in results:
+            if fd in self._readers:
+                self._readers[fd]()
+                continue
+            
+            obj = self.socket_map.get(fd)
+            if obj is None:
+                self.logger.critical('Invalid FD for poll(): %d', fd)
+                self.poller.unregister(fd)
+                continue
+            
+            # Stop if one of the handlers closed the connection
+            try:
+                if flags & (select.POLLIN | select.POLLPRI):
+                    obj.handle_read_event()
+                if flags & select.POLLOUT and obj._fileno is not None:
+                    obj.handle_write_event()
+                if flags & (select.POLLERR | select.POLLHUP | select.POLLNVAL) and obj._fileno is not None:
+                    obj.handle_expt_event()
+            except (asyncore.ExitNow, KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                obj.handle_error()
+
+# ---------------------------------------------------------------------------
+# Limits how fast we send. Tokens (bytes) drip in at rate bytes a second, up
+# to BURST_TIME seconds' worth, and sending uses them up. A rate of 0 means
+# no limit.
+
+# Most we let a connection send before it has to give the others a turn
+QUANTUM = 16384
+# How many seconds of tokens a bucket holds, but at least MIN_BURST bytes
+BURST_TIME = 0.1
+MIN_BURST = 4096
+
+class TokenBucket:
+    def __init__(self, rate=0):
+        self.rate = 0
+        self.tokens = 0
+        self.updated = time.time()
+        self.set_rate(rate)
+    
+    def set_rate(self, rate):
+        self.refill(time.time())
+        self.rate = rate
+        self.size = max(MIN_BURST, rate * BURST_TIME)
+        self.tokens = min(self.tokens, self.size)
+        
+        # Don't bother sending less than this at once
+        self.chunk = min(QUANTUM, self.size)
+    
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.size, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    # When there'll be enough tokens for a chunk
+    def ready_at(self):
+        if self.tokens >= self.chunk:
+            return self.updated
+        return self.updated + (self.chunk - self.tokens) / self.rate
+
+# ---------------------------------------------------------------------------
+# Works out how many connections to have open. Every so often it looks at how
+# fast we're posting: while another connection keeps making things faster we
+# add another one, once it stops helping (or connections start failing) we
+# drop one and stay there for a while before trying again.
+
+# An extra connection has to add at least this much of what each connection
+# was doing already to be worth keeping
+MIN_GAIN = 0.5
+# Intervals to wait after backing off before trying more connections again
+BACKOFF_HOLD = 6
+
+class ConnectionController:
+    def __init__(self, server, min_conns, max_conns, interval):
+        self.logger = logging.getLogger('mangler')
+        
+        self.server = server
+        self.min_conns = min_conns
+        self.max_conns = max_conns
+        self.interval = interval
+        
+        self._last_at = None
+        self._last_bytes = 0
+        self._last_errors = 0
+        self._conn_bytes = {}
+        
+        # The rate before we last added a connection, or None
+        self._before = None
+        self._ceiling = max_conns
+        self._hold = 0
+    
+    # Called from the main loop with the total bytes posted to our server
+    def check(self, now, total_bytes):
+        if self._last_at is not None and now - self._last_at < self.interval:
+            return
+        
+        # Start counting again if this is the first time, or a new connection
+        # is still logging in and the numbers wouldn't mean much
+        if self._last_at is None or self.server.logging_in():
+            self._start(now, total_bytes)
+            return
+        
+        interval = now - self._last_at
+        rate = (total_bytes - self._last_bytes) / interval
+        errors = self.server.errors - self._last_errors
+        self._last_errors = self.server.errors
+        
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for conn in self.server.conns:
+                sent = conn.bytes - self._conn_bytes.get(conn.connid, 0)
+                self.logger.debug('%d: %s/s', conn.connid, NiceSize(sent / interval))
+        
+        self._start(now, total_bytes)
+        
+        count = self.server.active_count()
+        before, self._before = self._before, None
+        
+        # Connections are failing, we probably have too many
+        if errors:
+            if count > self.min_conns:
+                self.logger.info('%d connection error(s), dropping to %d connection(s)', errors, count - 1)
+                self.server.remove_connection()
+                self._ceiling = count - 1
+            self._hold = BACKOFF_HOLD
+        
+        # The last one we added didn't help enough
+        elif before is not None and rate - before < before / max(1, count - 1) * MIN_GAIN:
+            self.logger.info('%d connection(s) not much faster than %d (%s/s), dropping back',
+                count, count - 1, NiceSize(rate))
+            self.server.remove_connection()
+            self._ceiling = count - 1
+            self._hold = BACKOFF_HOLD
+        
+        # Wait a while before trying again
+        elif self._hold:
+            self._hold -= 1
+            if self._hold == 0:
+                self._ceiling = self.max_conns
+        
+        # Try another one
+        elif count < self._ceiling and rate > 0:
+            self.logger.info('%s/s with %d connection(s), trying %d', NiceSize(rate), count, count + 1)
+            self.server.add_connection()
+            self._before = rate
+    
+    def _start(self, now, total_bytes):
+        self._last_at = now
+        self._last_bytes = total_bytes
+        self._conn_bytes = dict([(conn.connid, conn.bytes) for conn in self.server.conns])
+
+# ---------------------------------------------------------------------------
+
+class asyncNNTP(asyncore.dispatcher):
+    def __init__(self, pool, server, connid):
+        asyncore.dispatcher.__init__(self, map=pool.socket_map)
+        
+        self.logger = logging.getLogger('mangler')
+        
+        self.pool = pool
+        self.parent = pool.parent
+        self.server = server
         self.connid = connid
-        self.host = host
-        self.port = port
-        self.bindto = bindto
-        self.username = username
-        self.password = password
+        self.host = server.conf['hostname']
+        self.port = server.conf['port']
+        self.bindto = None
+        self.username = server.conf['username']
+        self.password = server.conf['password']
+        
+        # Don't bother formatting debug logging for every line if nobody's going
+        # to see it
+        self._debug = self.logger.isEnabledFor(logging.DEBUG)
+        
+        # Streaming sends up to this many articles before waiting to hear
+        # about the first one
+        self._streaming = server.conf['streaming']
+        self._window = max(1, server.conf['stream_window'])
+        
+        # Article data sent over this connection
+        self.bytes = 0
+        
+        # Set when the pool wants to get rid of us
+        self.retiring = False
         
         self.reset()
     
     def reset(self):
-        self._readbuf = ''
-        self._writebuf = ''
+        self._reader = LineReader()
+        self._writeq = collections.deque()
         self._article = None
-        self._pointer = 0
+        self._stream = collections.deque()
         
         self.reconnect_at = 0
         self.mode = MODE_AUTH
         self.state = STATE_DISCONNECTED
+        
+        # What we're waiting for and when we give up on it
+        self.waiting = None
+        self.deadline = None
 
     def do_connect(self):
         # Create the socket
@@ -106,7 +601,8 @@ class asyncNNTP(asyncore.dispatcher):
             self.really_close(msg)
         else:
             self.state = STATE_CONNECTING
-            self.logger.debug('%d: connecting to %s:%s', self.connid, self.host, self.port)
+            self.logger.debug('%d: connecting to %s (%s:%s)', self.connid, self.server.name, self.host, self.port)
+            self.watch()
     
     # -----------------------------------------------------------------------
     # Check to see if it's time to reconnect yet
@@ -120,18 +616,19 @@ class asyncNNTP(asyncore.dispatcher):
         asyncore.dispatcher.add_channel(self, map)
 
         # Add ourselves to the poll object
-        asyncore.poller.register(self._fileno)
+        self.pool.poller.register(self._fileno)
     
     def del_channel(self, map=None):
-        self.logger.debug('%d: removing FD %d from poller', self.connid, self._fileno)
+        fd = self._fileno
+        self.logger.debug('%d: removing FD %s from poller', self.connid, fd)
 
         # Remove ourselves from the async map
         asyncore.dispatcher.del_channel(self, map)
         
         # Remove ourselves from the poll object
-        if self._fileno is not None:
+        if fd is not None:
             try:
-                asyncore.poller.unregister(self._fileno)
+                self.pool.poller.unregister(fd)
             except KeyError:
                 pass
 
@@ -142,41 +639,82 @@ class asyncNNTP(asyncore.dispatcher):
     
     # -----------------------------------------------------------------------
     # We only want to be writable if we're connecting, or something is in our
-    # buffer.
+    # queue.
     def writable(self):
-        return (not self.connected) or len(self._writebuf)
+        return (not self.connected) or len(self._writeq)
     
-    # Send some data from our buffer when we can write
+    # Send as much data from our queue as we can when we can write. With a
+    # rate limit we only get to send our allowance before going to the back of
+    # the line.
     def handle_write(self):
         #self.logger.debug('%d wants to write!', self._fileno)
         
         if not self.writable():
             # We don't have any buffer, silly thing
-            asyncore.poller.register(self._fileno, select.POLLIN)
+            self.pool.poller.register(self._fileno, select.POLLIN)
             return
         
-        sent = asyncore.dispatcher.send(self, self._writebuf[self._pointer:])
-        self._pointer += sent
+        limit = None
+        if self.pool.shaped:
+            limit = self.pool.allowance(self)
+            if limit == 0:
+                self.pool.throttle(self, True)
+                return
+        
+        total = 0
+        while self._writeq:
+            data = self._writeq[0]
+            if limit is not None:
+                if total >= limit:
+                    break
+                data = data[:limit - total]
+            sent = asyncore.dispatcher.send(self, data)
+            
+            # The connection went away while we were sending
+            if self._fileno is None:
+                return
+            
+            # Only count article data
+            if self.mode == MODE_POST_DATA or self.mode == MODE_STREAM:
+                self.parent._bytes += sent
+                self.server.bytes += sent
+                self.bytes += sent
+            total += sent
+            
+            # The socket is full (or closed), or that's all we're allowed. Keep
+            # the rest for later.
+            if sent < len(self._writeq[0]):
+                if sent:
+                    self._writeq[0] = self._writeq[0][sent:]
+                break
+            
+            self._writeq.popleft()
+        
+        if limit is not None:
+            self.pool.spend(self, total)
+            if self._writeq:
+                self.pool.throttle(self)
         
-        # We've run out of data
-        if self._pointer == len(self._writebuf):
-            self._writebuf = ''
-            self._pointer = 0
-            asyncore.poller.register(self._fileno, select.POLLIN)
+        if not self._writeq:
+            # We've run out of data
+            self.pool.poller.register(self._fileno, select.POLLIN)
+            
+            # All of the article is gone, wait for the response. The article
+            # is kept until then in case it has to be tried again.
+            if self.mode == MODE_POST_DATA:
+                self.mode = MODE_POST_DONE
         
-        # If we're posting, we might need to read some more data from our file
-        if self.mode == MODE_POST_DATA:
-            self.parent._bytes += sent
-            if len(self._writebuf) == 0:
-                self.post_data()
+        self.watch(total > 0)
     
     # -----------------------------------------------------------------------
-    # We want buffered output, duh
+    # We want buffered output, duh. Data is queued as memoryviews so that
+    # sending part of it doesn't mean copying the rest.
     def send(self, data):
-        self._writebuf += data
-        # We need to know about writable things now
-        asyncore.poller.register(self._fileno)
-        #self.logger.debug('%d has data!', self._fileno)
+        if not self._writeq:
+            # We need to know about writable things now
+            self.pool.poller.register(self._fileno)
+            #self.logger.debug('%d has data!', self._fileno)
+        self._writeq.append(memoryview(data))
     
     # -----------------------------------------------------------------------
     
@@ -186,58 +724,63 @@ class asyncNNTP(asyncore.dispatcher):
     # -----------------------------------------------------------------------
     
     def handle_connect(self):
-        self.status = STATE_CONNECTED
+        self.state = STATE_CONNECTED
         self.logger.debug('%d: connected!', self.connid)
+        self.watch()
     
     def handle_close(self):
         self.really_close()
     
     def really_close(self, error=None):
+        # Whatever we were posting has to go back in the queue
+        if self._article is not None:
+            self.parent.post_failed(self._article, 'connection closed')
+        for article in self._stream:
+            self.parent.post_failed(article, 'connection closed')
+        
         self.mode = MODE_COMMAND
-        self.status = STATE_DISCONNECTED
+        self.state = STATE_DISCONNECTED
         
         self.close()
         self.reset()
+        self.pool.conn_closed(self)
+        
+        # However we got closed, give the server a rest before trying again
+        self.reconnect_at = time.time() + self.server.conf['reconnect_delay']
         
         if error and hasattr(error, 'args'):
             self.logger.warning('%d: %s!', self.connid, error.args[1])
-            self.reconnect_at = time.time() + self.parent.conf['server']['reconnect_delay']
         else:
             self.logger.warning('%d: Connection closed: %s', self.connid, error)
     
     # There is some data waiting to be read
     def handle_read(self):
         try:
-            self._readbuf += self.recv(16384)
+            data = self.recv(16384)
         except socket.error, msg:
             self.really_close(msg)
             return
         
-        # Split the buffer into lines. Last line is always incomplete.
-        lines = self._readbuf.split('\r\n')
-        self._readbuf = lines.pop()
-        
         # Do something useful here
-        for line in lines:
-            self.logger.debug('%d: < %s', self.connid, line)
+        for line in self._reader.feed(data):
+            if self._debug:
+                self.logger.debug('%d: < %s', self.connid, line)
+            
+            resp = ParseResponse(line)[0]
 
             # Initial login stuff
             if self.mode == MODE_AUTH:
-                resp = line.split(None, 1)[0]
-                
                 # Welcome... post, no post
-                if resp in ('200', '201'):
+                if resp in (200, 201):
                     if self.username:
                         text = 'AUTHINFO USER %s\r\n' % (self.username)
                         self.send(text)
                         self.logger.debug('%d: > AUTHINFO USER ********', self.connid)
                     else:
-                        self.mode = MODE_COMMAND
-                        self.parent._idle.append(self)
-                        self.logger.debug('%d: ready.', self.connid)
+                        self.logged_in()
                 
                 # Need password too
-                elif resp in ('381'):
+                elif resp == 381:
                     if self.password:
                         text = 'AUTHINFO PASS %s\r\n' % (self.password)
                         self.send(text)
@@ -246,13 +789,11 @@ class asyncNNTP(asyncore.dispatcher):
                         self.really_close('need password!')
                 
                 # Auth ok
-                elif resp in ('281'):
-                    self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
-                    self.logger.debug('%d: ready.', self.connid)
+                elif resp == 281:
+                    self.logged_in()
                 
                 # Auth failure
-                elif resp in ('502'):
+                elif resp == 502:
                     self.really_close('authentication failure.')
                 
                 # Dunno
@@ -260,11 +801,44 @@ class asyncNNTP(asyncore.dispatcher):
                     self.logger.warning('%d: unknown response while MODE_AUTH - "%s"',
                         self.connid, line)
             
+            # Asked for streaming
+            elif self.mode == MODE_STREAM_INIT:
+                if resp == 203:
+                    self.mode = MODE_STREAM
+                    self.logger.debug('%d: ready, streaming.', self.connid)
+                else:
+                    self.mode = MODE_COMMAND
+                    self.logger.info('%d: server does not support streaming, using POST', self.connid)
+                self.pool.conn_idle(self)
+            
+            # Streamed articles
+            elif self.mode == MODE_STREAM:
+                # Accepted, or rejected. 431 is try again later.
+                if resp in (239, 431, 439) and self._stream:
+                    article = self.stream_done(line)
+                    if resp == 239:
+                        self.parent.post_success(article)
+                        article.release()
+                    else:
+                        # 439 means the server won't ever take it, it's only
+                        # worth trying again after a 431
+                        self.logger.warning('%d: posting failed - %s', self.connid, line)
+                        self.parent.post_failed(article, line, resp == 431)
+                    
+                    # There's room for another one if we were full, or we
+                    # might be finished if we're closing
+                    if len(self._stream) == self._window - 1 or (self.retiring and not self._stream):
+                        self.pool.conn_idle(self)
+                
+                # WTF?
+                else:
+                    self.logger.warning('%d: unknown response while MODE_STREAM - "%s"',
+                        self.connid, line)
+            
             # Posting a file
             elif self.mode == MODE_POST_INIT:
-                resp = line.split(None, 1)[0]
                 # Posting is allowed
-                if resp == '340':
+                if resp == 340:
                     self.mode = MODE_POST_DATA
                     
                     # TODO: use the suggested message-ID, will require some rethinking as to how
@@ -275,17 +849,16 @@ class asyncNNTP(asyncore.dispatcher):
                         self._article.headers['Message-ID'] = m.group(1)
 
                     # Prepare the article for posting
-                    article_size = self._article.prepare()
-                    self.parent.remember_msgid(article_size, self._article)
-
-                    self.post_data()
+                    self._article.prepare()
+                    self.post_data(self._article)
                 
                 # Posting is not allowed
-                elif resp == '440':
-                    self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
-                    del self._article
+                elif resp == 440:
                     self.logger.warning('%d: posting not allowed!', self.connid)
+                    self.parent.post_failed(self._article, line)
+                    self._article = None
+                    self.mode = MODE_COMMAND
+                    self.pool.conn_idle(self)
                 
                 # WTF?
                 else:
@@ -294,19 +867,22 @@ class asyncNNTP(asyncore.dispatcher):
             
             # Done posting
             elif self.mode == MODE_POST_DONE:
-                resp = line.split(None, 1)[0]
                 # Ok
-                if resp == '240':
-                    #self.parent.post_success(self._article)
+                if resp == 240:
+                    self.parent.post_success(self._article)
+                    self._article.release()
+                    self._article = None
 
                     self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
+                    self.pool.conn_idle(self)
 
                 # Not ok
-                elif resp.startswith('44'):
-                    self.mode = MODE_COMMAND
-                    self.parent._idle.append(self)
+                elif 440 <= resp <= 449:
                     self.logger.warning('%d: posting failed - %s', self.connid, line)
+                    self.parent.post_failed(self._article, line)
+                    self._article = None
+                    self.mode = MODE_COMMAND
+                    self.pool.conn_idle(self)
                 
                 # WTF?
                 else:
@@ -317,22 +893,103 @@ class asyncNNTP(asyncore.dispatcher):
             else:
                 self.logger.warning('%d: unknown response from server - "%s"',
                     self.connid, line)
+        
+        if self._fileno is not None:
+            self.watch(True)
+    
+    # -----------------------------------------------------------------------
+    # Work out what we're waiting for. Something new starts the clock again,
+    # and so does progress on the same thing.
+    def watch(self, progress=False):
+        if self.state == STATE_CONNECTING:
+            waiting = 'connect'
+        elif self.mode in (MODE_AUTH, MODE_STREAM_INIT):
+            waiting = 'login'
+        elif self._writeq and self.mode in (MODE_POST_DATA, MODE_STREAM):
+            waiting = 'send'
+        elif self.mode == MODE_POST_INIT:
+            waiting = 'post'
+        elif self.mode == MODE_POST_DONE or (self.mode == MODE_STREAM and self._stream):
+            waiting = 'reply'
+        else:
+            waiting = None
+        
+        if waiting != self.waiting or progress:
+            self.waiting = waiting
+            timeout = waiting and self.server.conf[STALLS[waiting][0]]
+            if timeout:
+                self.deadline = time.time() + timeout
+            else:
+                self.deadline = None
+    
+    # We've waited too long, try again with a new connection. Whatever we were
+    # posting goes back in the queue.
+    def stalled(self):
+        self.server.stalls[self.waiting] = self.server.stalls.get(self.waiting, 0) + 1
+        self.really_close(socket.timeout(errno.ETIMEDOUT, 'stalled %s' % (STALLS[self.waiting][1])))
+    
+    # -----------------------------------------------------------------------
+    # We're logged in, try to start streaming if we want to
+    def logged_in(self):
+        if self._streaming:
+            self.mode = MODE_STREAM_INIT
+            self.send('MODE STREAM\r\n')
+            self.logger.debug('%d: > MODE STREAM', self.connid)
+        else:
+            self.mode = MODE_COMMAND
+            self.pool.conn_idle(self)
+            self.logger.debug('%d: ready.', self.connid)
+    
+    # How many articles we're waiting to hear about
+    def in_flight(self):
+        return len(self._stream) + (self._article is not None)
     
     # -----------------------------------------------------------------------
     # Guess what this does!
     def post_article(self, article):
+        if self.mode == MODE_STREAM:
+            self.stream_article(article)
+            return
+        
         self.mode = MODE_POST_INIT
         self._article = article
         self.send('POST\r\n')
         self.logger.debug('%d: > POST', self.connid)
+        self.watch()
+    
+    def post_data(self, article):
+        for data in article.buffers:
+            self.send(data)
+    
+    # Send an article with TAKETHIS without waiting for the server. We stay
+    # idle until the window is full.
+    def stream_article(self, article):
+        article.prepare()
+        self._stream.append(article)
+        
+        msgid = article.headers['Message-ID']
+        self.send('TAKETHIS %s\r\n' % (msgid))
+        if self._debug:
+            self.logger.debug('%d: > TAKETHIS %s', self.connid, msgid)
+        self.post_data(article)
+        self.watch()
+        
+        if len(self._stream) < self._window:
+            self.pool.conn_idle(self)
     
-    def post_data(self):
-        data = self._article.postfile.read(POST_READ_SIZE)
-        if len(data) == 0:
-            self.mode = MODE_POST_DONE
-            self._article.postfile.close()
-            self._article.postfile = None
+    # Find the streamed article a response is about. They should come back in
+    # order, but the Message-ID says for sure.
+    def stream_done(self, line):
+        m = MSGID_RE.search(line)
+        i = 0
+        if m:
+            for j, article in enumerate(self._stream):
+                if article.headers['Message-ID'] == m.group(1):
+                    i = j
+                    break
         
-        self.send(data)
+        article = self._stream[i]
+        del self._stream[i]
+        return article
 
 # ---------------------------------------------------------------------------
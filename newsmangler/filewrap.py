@@ -27,34 +27,374 @@
 
 """Simple file wrapper to handle opening and closing on demand."""
 
+import collections
 import logging
+import mmap
+import os
+import threading
+import time
+
+# ---------------------------------------------------------------------------
+# posix_fadvise() isn't in the os module until Python 3.3, so try to get it
+# out of libc ourselves.
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# nocache mode reads whole pages at a time so that the ones we're done with can
+# be dropped from the page cache
+PAGE_SIZE = mmap.PAGESIZE
+
+_posix_fadvise = getattr(os, 'posix_fadvise', None)
+if _posix_fadvise is None:
+	try:
+		import ctypes
+		import ctypes.util
+		_posix_fadvise = ctypes.CDLL(ctypes.util.find_library('c')).posix_fadvise
+		_posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+	except (ImportError, OSError, AttributeError, TypeError):
+		_posix_fadvise = None
+
+# Give the kernel a hint about what we're going to do with part of a file.
+# Does nothing if we can't.
+def FAdvise(fd, offset, length, advice):
+	if _posix_fadvise is not None:
+		try:
+			_posix_fadvise(fd, offset, length, advice)
+		except (OSError, ValueError):
+			pass
+
+# Drop part of a file from the page cache. The kernel only drops pages that
+# are entirely inside the range, so it's widened out to whole pages. The page
+# a part shares with the next one has to be read again, but that's better than
+# leaving one behind for every part.
+def DropPages(fd, begin, end):
+	start = begin // PAGE_SIZE * PAGE_SIZE
+	stop = (end + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+	FAdvise(fd, start, stop - start, POSIX_FADV_DONTNEED)
+
+# ---------------------------------------------------------------------------
+# Map a whole file, the mapping has its own file descriptor
+def _MapFile(filepath):
+	f = open(filepath, 'rb')
+	try:
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		f.close()
+
+# The file each encode worker mapped last. Parts of a file are handed out in
+# order, so keeping the one mapping around saves mapping the whole file again
+# for every part. It's let go once the last part has been read.
+_mapped = threading.local()
+
+def _MapPart(filepath, begin, end):
+	if getattr(_mapped, 'filepath', None) != filepath:
+		_mapped.map = _MapFile(filepath)
+		_mapped.filepath = filepath
+	
+	data = buffer(_mapped.map, begin, end - begin)
+	if end >= len(_mapped.map):
+		_mapped.map = _mapped.filepath = None
+	return data
+
+# Read the data for one part of a file. In mmap mode this returns a buffer()
+# of the mapped file instead of a string, which keeps the mapping alive until
+# the buffer goes away. Parts read in order can share a mapping, anything else
+# should use keep_map=False. In nocache mode the part is dropped from the page
+# cache once it has been read.
+def ReadPart(filepath, begin, end, read_mode='read', keep_map=True):
+	if read_mode == 'mmap':
+		if keep_map:
+			return _MapPart(filepath, begin, end)
+		return buffer(_MapFile(filepath), begin, end - begin)
+
+	f = open(filepath, 'rb')
+	try:
+		f.seek(begin, 0)
+		data = f.read(end - begin)
+		if read_mode == 'nocache':
+			DropPages(f.fileno(), begin, end)
+		return data
+	finally:
+		f.close()
+
+# ---------------------------------------------------------------------------
 
 class FileWrap:
-	def __init__(self, filepath, parts):
+	def __init__(self, filepath, parts, read_mode='read', readahead=None):
 		self._filepath = filepath
 		self._parts = parts
+		self.read_mode = read_mode
+		self.readahead = readahead
 		
 		self._file = None
+		self._map = None
+		
+		# nocache mode reads up to the next page boundary, this is the bit past
+		# the end of the last part and where it starts
+		self._carry = ''
+		self._carry_at = None
 
 		self.logger = logging.getLogger('mangler')
 
+	# Change how many parts we're going to be asked for
+	def set_parts(self, parts):
+		self._parts = parts
+
+	def add_parts(self, parts):
+		self._parts += parts
+
 	def read_part(self, begin, end):
 		self.logger.debug('%s read_part %d %d', self._filepath, begin, end)
 
+		# The read-ahead thread might have done the work already
+		data = None
+		if self.readahead is not None:
+			data = self.readahead.take(self._filepath, begin)
+
 		# Open the file if it's not already open
-		if self._file is None:
+		if data is not None:
+			pass
+		elif self._file is None and self._map is None:
 			self.logger.debug('%s read_part open file', self._filepath)
-			self._file = open(self._filepath, 'rb')
+			if self.read_mode == 'nocache':
+				self._file = open(self._filepath, 'rb', 0)
+				FAdvise(self._file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+			else:
+				self._file = open(self._filepath, 'rb')
+			
+			# Map the whole file, the mapping has its own file descriptor
+			if self.read_mode == 'mmap':
+				self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+				self._file.close()
+				self._file = None
 
-		# Seek to the right position and read the data
-		self._file.seek(begin, 0)
-		data = self._file.read(end - begin)
+		# Slice the mapping, or seek to the right position and read the data
+		if data is not None:
+			pass
+		elif self._map is not None:
+			data = buffer(self._map, begin, end - begin)
+		elif self.read_mode == 'nocache':
+			data = self._read_nocache(begin, end)
+		else:
+			self._file.seek(begin, 0)
+			data = self._file.read(end - begin)
 
-		# If this was the last part we should close the file
+		# If this was the last part we should close the file. A mapping can't be
+		# closed while buffers of it are still around, it goes away once the
+		# last one has been encoded.
 		self._parts -= 1
 		if self._parts == 0:
 			self.logger.debug('%s read_part close file', self._filepath)
-			self._file.close()
+			if self._map is not None:
+				self._map = None
+			elif self._file is not None:
+				# Catch anything the kernel read ahead after we last dropped it
+				if self.read_mode == 'nocache':
+					FAdvise(self._file.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+				self._file.close()
+				self._file = None
+			self._carry = ''
+			self._carry_at = None
 
 		# Return the data
 		return data
+
+	# Read a part in whole pages, keeping whatever is past the end of it for the
+	# next part, and tell the kernel it can forget about the pages we've read.
+	# Parts are normally read in order, anything else just gets read.
+	def _read_nocache(self, begin, end):
+		if self._carry_at == begin:
+			data = self._carry
+		else:
+			data = ''
+		
+		pos = begin + len(data)
+		if pos < end:
+			read_end = (end + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+			self._file.seek(pos, 0)
+			data += self._file.read(read_end - pos)
+			
+			start = pos // PAGE_SIZE * PAGE_SIZE
+			FAdvise(self._file.fileno(), start, read_end - start, POSIX_FADV_DONTNEED)
+		
+		self._carry = data[end - begin:]
+		self._carry_at = end
+		return data[:end - begin]
+
+	# The caller is finished with data from read_part()
+	def done_part(self, data):
+		if self.readahead is not None:
+			self.readahead.release(data)
+
+	# Read a part again after read_part() has been and gone, for retries
+	def reread(self, begin, end):
+		return ReadPart(self._filepath, begin, end, self.read_mode, keep_map=False)
+
+# ---------------------------------------------------------------------------
+# Reads parts in a background thread before they're needed, so the main loop
+# doesn't sit waiting on the disk. Parts are read in the order they're asked
+# for into a fixed set of buffers, which go back to the pool once the part has
+# been encoded. The parts after the one being read are passed to the kernel as
+# WILLNEED so it can start on them too.
+#
+# How far ahead we read depends on how long a read takes compared to how often
+# parts get used, there's no point tying up every buffer if the disk can keep
+# up anyway.
+#
+# With nocache the pages we've read are dropped from the page cache again.
+class ReadAhead:
+	def __init__(self, buffers, size, wakeup=None, nocache=False):
+		self._free = [bytearray(size) for i in range(buffers)]
+		self._wakeup = wakeup
+		self._nocache = nocache
+		
+		self._cond = threading.Condition()
+		self._wanted = collections.deque()
+		self._requested = set()
+		self._done = {}
+		self._lent = {}
+		self._stopping = False
+		
+		self.buffers = buffers
+		self.distance = 1
+		self._read_time = 0.0
+		self._interval = None
+		self._last_take = None
+		
+		self.logger = logging.getLogger('mangler')
+		
+		self._thread = threading.Thread(target=self._run, name='readahead')
+		self._thread.daemon = True
+		self._thread.start()
+	
+	def stop(self):
+		with self._cond:
+			self._stopping = True
+			self._cond.notify_all()
+		self._thread.join()
+	
+	# Ask for a part to be read
+	def want(self, filepath, begin, end):
+		with self._cond:
+			self._wanted.append((filepath, begin, end))
+			self._requested.add((filepath, begin))
+			self._cond.notify_all()
+	
+	# Is this part ready, or not something we're reading anyway?
+	def ready(self, filepath, begin):
+		key = (filepath, begin)
+		return key in self._done or key not in self._requested
+	
+	# Get a part we've read, waiting for it if we have to. Returns None if the
+	# part was never asked for.
+	def take(self, filepath, begin):
+		key = (filepath, begin)
+		with self._cond:
+			while key not in self._done:
+				if key not in self._requested:
+					return None
+				self._cond.wait()
+			
+			self._requested.discard(key)
+			buf, length = self._done.pop(key)
+			self._update_distance()
+			self._cond.notify_all()
+		
+		data = buffer(buf, 0, length)
+		self._lent[id(data)] = buf
+		return data
+	
+	# Put a buffer from take() back in the pool
+	def release(self, data):
+		buf = self._lent.pop(id(data), None)
+		if buf is not None:
+			with self._cond:
+				self._free.append(buf)
+				self._cond.notify_all()
+	
+	# Work out how many parts we need to be ahead by to keep up, from the time
+	# between take() calls and how long a read takes. Called with the lock held.
+	def _update_distance(self):
+		now = time.time()
+		if self._last_take is not None:
+			interval = now - self._last_take
+			if self._interval is None:
+				self._interval = interval
+			else:
+				self._interval = self._interval * 0.8 + interval * 0.2
+		self._last_take = now
+		
+		if self._interval:
+			self.distance = max(1, min(self.buffers, int(self._read_time / self._interval) + 2))
+		else:
+			self.distance = self.buffers
+	
+	# -----------------------------------------------------------------------
+	# The reader thread
+	def _run(self):
+		f = None
+		filepath = None
+		
+		while True:
+			with self._cond:
+				# Wait until there's something to read, a buffer to read it into,
+				# and we're not already far enough ahead
+				while not self._stopping and not (self._wanted and self._free and
+					len(self._done) < self.distance):
+					self._cond.wait()
+				if self._stopping:
+					break
+				
+				path, begin, end = self._wanted.popleft()
+				buf = self._free.pop()
+				hints = list(self._wanted)[:self.distance]
+			
+			start = time.time()
+			try:
+				if path != filepath:
+					if f is not None:
+						self._close(f)
+					f = None
+					f = open(path, 'rb')
+					filepath = path
+				
+				# Let the kernel know what's coming after this
+				for hpath, hbegin, hend in hints:
+					if hpath == filepath:
+						FAdvise(f.fileno(), hbegin, hend - hbegin, POSIX_FADV_WILLNEED)
+				
+				f.seek(begin, 0)
+				length = f.readinto(memoryview(buf)[:end - begin])
+				if self._nocache:
+					DropPages(f.fileno(), begin, end)
+			except (IOError, OSError), msg:
+				# Let read_part() have a go at it and complain properly
+				self.logger.warning('read-ahead of %s failed: %s', path, msg)
+				with self._cond:
+					self._free.append(buf)
+					self._requested.discard((path, begin))
+					self._cond.notify_all()
+				if f is not None:
+					self._close(f)
+				f = None
+				filepath = None
+				continue
+			
+			with self._cond:
+				self._read_time = self._read_time * 0.8 + (time.time() - start) * 0.2
+				self._done[(path, begin)] = (buf, length)
+				self._cond.notify_all()
+			
+			if self._wakeup is not None:
+				self._wakeup()
+		
+		if f is not None:
+			self._close(f)
+	
+	# Done with a file. Anything the kernel read ahead past the parts we've
+	# dropped goes as well.
+	def _close(self, f):
+		if self._nocache:
+			FAdvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+		f.close()
@@ -0,0 +1,103 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""An append-only record of the articles that have been posted, so that a post
+can be picked up again if we get killed halfway through."""
+
+import logging
+import os
+import time
+
+# ---------------------------------------------------------------------------
+# Read the records from a journal. Returns a dict of filepath to a list of
+# (part number, size, Message-ID). A line that didn't get written completely
+# before we died is ignored. Paths are escaped, a tab or newline in one would
+# break the line up otherwise.
+def ReadJournal(filepath):
+	records = {}
+	
+	f = open(filepath, 'rb')
+	try:
+		for line in f:
+			if not line.endswith('\n'):
+				break
+			
+			fields = line[:-1].split('\t')
+			if len(fields) != 4:
+				continue
+			try:
+				partnum, size = int(fields[1]), int(fields[2])
+			except ValueError:
+				continue
+			
+			records.setdefault(fields[0].decode('string_escape'), []).append((partnum, size, fields[3]))
+	finally:
+		f.close()
+	
+	return records
+
+# ---------------------------------------------------------------------------
+# Appends a line for each article as it's posted. Lines are written out and
+# fsync()ed every sync_interval seconds instead of every time, losing the last
+# few just means posting them again.
+class Journal:
+	def __init__(self, filepath, sync_interval=1.0):
+		self.filepath = filepath
+		self._sync_interval = sync_interval
+		self._last_sync = time.time()
+		self._dirty = False
+		
+		self._file = open(filepath, 'ab')
+		
+		self.logger = logging.getLogger('mangler')
+	
+	def add(self, filepath, partnum, size, msgid):
+		self._file.write('%s\t%d\t%d\t%s\n' % (filepath.encode('string_escape'), partnum, size, msgid))
+		self._dirty = True
+		self.check_sync()
+	
+	# Sync if it's been long enough since the last time
+	def check_sync(self, now=None):
+		if now is None:
+			now = time.time()
+		if self._dirty and now - self._last_sync >= self._sync_interval:
+			self.sync()
+			self._last_sync = now
+	
+	def sync(self):
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._dirty = False
+	
+	def close(self):
+		self.sync()
+		self._file.close()
+	
+	# All done, we don't need it any more
+	def remove(self):
+		self._file.close()
+		os.remove(self.filepath)
@@ -0,0 +1,323 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Leases on parts of a post for posting nodes, so that several hosts can work
+on one release. A coordinator splits the articles into leases and hands them
+out over TCP, workers post them and report back. Messages are lines of JSON."""
+
+import collections
+import json
+import logging
+import time
+
+from newsmangler.asyncnntp import LineReader
+
+# ---------------------------------------------------------------------------
+# Turn 'host:port' into something for connect() or bind()
+def ParseAddress(address):
+	host, _, port = address.rpartition(':')
+	return (host, int(port))
+
+# JSON wants unicode, but paths and subjects are whatever bytes they are. Going
+# through latin-1 gets every byte there and back unchanged.
+def ToWire(obj):
+	if isinstance(obj, str):
+		return obj.decode('latin-1')
+	elif isinstance(obj, (list, tuple)):
+		return [ToWire(o) for o in obj]
+	elif isinstance(obj, dict):
+		return dict([(k, ToWire(v)) for k, v in obj.items()])
+	return obj
+
+def FromWire(obj):
+	if isinstance(obj, unicode):
+		return obj.encode('latin-1')
+	elif isinstance(obj, list):
+		return [FromWire(o) for o in obj]
+	elif isinstance(obj, dict):
+		return dict([(str(k), FromWire(v)) for k, v in obj.items()])
+	return obj
+
+# ---------------------------------------------------------------------------
+# One end of a coordinator <-> worker connection. Sends block, but messages
+# are small and reading is only done when the poller says there's something
+# there.
+class Channel:
+	def __init__(self, sock, name=None, timeout=30):
+		self.sock = sock
+		self.sock.settimeout(timeout)
+		self.name = name
+		self._reader = LineReader()
+	
+	def fileno(self):
+		return self.sock.fileno()
+	
+	def send(self, message):
+		self.sock.sendall(json.dumps(ToWire(message)) + '\r\n')
+	
+	# Read whatever has turned up, raises EOFError if the other end is gone
+	def read(self):
+		data = self.sock.recv(65536)
+		if not data:
+			raise EOFError
+		return [FromWire(json.loads(line)) for line in self._reader.feed(data)]
+	
+	# Wait for the next message
+	def wait(self):
+		while 1:
+			messages = self.read()
+			if messages:
+				return messages[0]
+	
+	def close(self):
+		self.sock.close()
+
+# ---------------------------------------------------------------------------
+
+class Lease:
+	def __init__(self, leaseid, parts):
+		self.id = leaseid
+		self.parts = set(parts)
+		self.worker = None
+		self.expires = 0
+
+# The coordinator's side. Every article is in exactly one lease until it has
+# been posted or given up on. A lease whose worker goes away, or that isn't
+# renewed in time, goes back to the front of the queue with whatever is left
+# in it, and the next worker to ask gets it.
+class LeaseTable:
+	def __init__(self, parts, size, timeout):
+		self.timeout = timeout
+		
+		self._free = collections.deque()
+		self._held = {}
+		self._owner = {}
+		
+		lease = None
+		for part in parts:
+			if lease is None or len(lease.parts) >= size:
+				lease = Lease(len(self._free), ())
+				self._free.append(lease)
+			lease.parts.add(part)
+			self._owner[part] = lease
+	
+	def __len__(self):
+		return len(self._owner)
+	
+	# Nothing left to hand out or wait for
+	def finished(self):
+		return not self._free and not self._held
+	
+	# Give the next lease to a worker, or None if there isn't one free
+	def grant(self, worker, now):
+		if not self._free:
+			return None
+		lease = self._free.popleft()
+		lease.worker = worker
+		lease.expires = now + self.timeout
+		self._held[lease.id] = lease
+		return lease
+	
+	# Keep a worker's leases going. Returns the ones it doesn't have any more,
+	# they expired and might have been handed to someone else.
+	def renew(self, leaseids, worker, now):
+		revoked = []
+		for leaseid in leaseids:
+			lease = self._held.get(leaseid)
+			if lease is not None and lease.worker == worker:
+				lease.expires = now + self.timeout
+			else:
+				revoked.append(leaseid)
+		return revoked
+	
+	# An article has been posted. Returns False if someone else got there
+	# first, a lease that was handed out again might have been posted twice.
+	def posted(self, part):
+		lease = self._owner.pop(part, None)
+		if lease is None:
+			return False
+		lease.parts.discard(part)
+		if not lease.parts:
+			self._held.pop(lease.id, None)
+			if lease in self._free:
+				self._free.remove(lease)
+		return True
+	
+	# A worker ran out of retries for an article, it's left for --resume
+	def failed(self, part):
+		self.posted(part)
+	
+	# A worker went away, put its leases back
+	def release(self, worker):
+		for lease in self._held.values():
+			if lease.worker == worker:
+				self._take_back(lease)
+	
+	# Take back any leases that haven't been renewed in time, returns them
+	def expire(self, now):
+		expired = [lease for lease in self._held.values() if lease.expires < now]
+		for lease in expired:
+			self._take_back(lease)
+		return expired
+	
+	def _take_back(self, lease):
+		del self._held[lease.id]
+		lease.worker = None
+		self._free.appendleft(lease)
+
+# ---------------------------------------------------------------------------
+# The worker's side. PostMangler sends us what it would send a coordinator
+# from a shard, and we turn that into messages. Leases we're given go on the
+# end of the article list, and we ask for another one when that gets short.
+class LeaseClient:
+	def __init__(self, channel, articles, pool):
+		self.logger = logging.getLogger('mangler')
+		
+		self.channel = channel
+		self.articles = articles
+		self.pool = pool
+		
+		self._leases = {}
+		self._revoked = set()
+		self._asking = False
+		self._finished = False
+		self._lost = False
+		self._ask_after = 0
+		self._low = 1
+		self._timeout = 60
+		self._renew_at = 0
+	
+	# We're done once the coordinator says so and everything we have is
+	# posted
+	def finished(self):
+		return self._finished and not self._leases
+	
+	# Messages from the coordinator
+	def read(self):
+		try:
+			messages = self.channel.read()
+		except EOFError:
+			self.lost('connection closed')
+			return
+		except IOError, msg:
+			self.lost(msg)
+			return
+		
+		for message in messages:
+			if message['cmd'] == 'lease':
+				self._asking = False
+				self.add_lease(message)
+			elif message['cmd'] == 'wait':
+				self._asking = False
+				self._ask_after = time.time() + 1
+			elif message['cmd'] == 'finished':
+				self._asking = False
+				self._finished = True
+			elif message['cmd'] == 'revoke':
+				self.revoke(message['leases'])
+	
+	def add_lease(self, message):
+		parts = [tuple(part) for part in message['parts']]
+		self._leases[message['lease']] = set(parts)
+		self._timeout = message['timeout']
+		self._low = max(1, len(parts) // 2)
+		self.logger.debug('Got lease %d with %d article(s)', message['lease'], len(parts))
+		
+		# Group them by file, they're in order anyway
+		byfile = collections.OrderedDict()
+		for fileid, partnum in parts:
+			byfile.setdefault(fileid, []).append(partnum)
+		for fileid, partnums in byfile.items():
+			self.articles.file(fileid)[0].add_parts(len(partnums))
+			self.articles.add_parts(fileid, partnums)
+	
+	# We were too slow renewing these, someone else is posting them now
+	def revoke(self, leaseids):
+		for leaseid in leaseids:
+			parts = self._leases.pop(leaseid, None)
+			if parts:
+				self.logger.warning('Lease %d was taken back, skipping %d article(s)', leaseid, len(parts))
+				self._revoked.update(parts)
+	
+	# Is an article from a lease we don't have any more?
+	def revoked(self, article):
+		part = (article._fileinfo['fileid'], article._partnum)
+		if part in self._revoked:
+			self._revoked.discard(part)
+			return True
+		return False
+	
+	# Something happened to an article
+	def send(self, message):
+		if message[0] in ('posted', 'failed'):
+			part = (message[1], message[2])
+			for leaseid, parts in self._leases.items():
+				if part in parts:
+					parts.discard(part)
+					if not parts:
+						del self._leases[leaseid]
+					break
+			
+			if message[0] == 'posted':
+				self._send({'cmd': 'posted', 'part': part, 'size': message[3], 'msgid': message[4]})
+			else:
+				self._send({'cmd': 'failed', 'part': part})
+		
+		elif message[0] == 'bytes':
+			self._send({'cmd': 'bytes', 'bytes': message[1]})
+	
+	# Called every now and then from the main loop
+	def check(self, now):
+		if self._leases and now >= self._renew_at:
+			self._send({'cmd': 'renew', 'leases': self._leases.keys()})
+			self._renew_at = now + self._timeout / 3.0
+		
+		if not self._asking and not self._finished and now >= self._ask_after and len(self.articles) < self._low:
+			self._send({'cmd': 'lease'})
+			self._asking = True
+			if not self._leases:
+				self._renew_at = now
+	
+	# Without the coordinator there's nobody to ask for more, so we finish
+	# whatever is already queued and stop. The channel is closed and taken
+	# out of the poller, a dead socket would keep it awake.
+	def lost(self, msg):
+		if not self._lost:
+			self.logger.error('Lost the coordinator: %s', msg)
+			self._lost = True
+			self.pool.remove_reader(self.channel.fileno())
+			self.channel.close()
+		self._finished = True
+		self._leases.clear()
+	
+	def _send(self, message):
+		if self._lost:
+			return
+		try:
+			self.channel.send(message)
+		except IOError, msg:
+			self.lost(msg)
@@ -0,0 +1,172 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Bookkeeping for the articles we've posted, and writing them out as an NZB
+one file at a time."""
+
+import logging
+import os
+import time
+
+from array import array
+
+try:
+	import xml.etree.cElementTree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
+
+from newsmangler.common import NM_VERSION
+
+# ---------------------------------------------------------------------------
+# Posted segments, kept in a few flat arrays per file instead of holding on to
+# every Article. Message-IDs are stored one after another in a single buffer.
+# Files are taken out again once they're complete, so this only ever has the
+# files that are still being posted in it.
+class SegmentStore:
+	def __init__(self):
+		self.clear()
+	
+	def __len__(self):
+		return self._count
+	
+	def clear(self):
+		# fileid: [subject, post time, part numbers, sizes, Message-ID ends, Message-IDs]
+		self._files = {}
+		self._order = []
+		self._count = 0
+	
+	# Remember a segment, returns how many segments we have for that file
+	def add(self, fileid, subject, partnum, size, msgid):
+		info = self._files.get(fileid)
+		if info is None:
+			info = self._files[fileid] = [subject, int(time.time()), array('I'), array('I'), array('L'), bytearray()]
+			self._order.append(fileid)
+		
+		info[2].append(partnum)
+		info[3].append(size)
+		info[5].extend(msgid[1:-1])
+		info[4].append(len(info[5]))
+		self._count += 1
+		return len(info[2])
+	
+	# Take a file out of the store. Returns (subject, post time, segments), with
+	# segments being a list of (part number, size, Message-ID) in part order.
+	def pop(self, fileid):
+		subject, posttime, partnums, sizes, ends, msgids = self._files.pop(fileid)
+		self._order.remove(fileid)
+		self._count -= len(partnums)
+		
+		segments = []
+		start = 0
+		for i in xrange(len(partnums)):
+			segments.append((int(partnums[i]), int(sizes[i]), str(msgids[start:ends[i]])))
+			start = ends[i]
+		segments.sort()
+		
+		return subject, posttime, segments
+	
+	# File ids we have segments for, in the order we first saw them
+	def fileids(self):
+		return list(self._order)
+
+# ---------------------------------------------------------------------------
+# Writes an NZB as we go. Each <file> is written as soon as all of its parts
+# have been posted, anything left over goes at the end. The NZB is written to a
+# temporary file in the folder it's going to end up in, and renamed into place
+# once it's finished.
+class NZBWriter:
+	def __init__(self, filename, folder, poster, newsgroups):
+		self.filename = filename
+		self.filepath = os.path.join(folder, filename)
+		self._poster = poster
+		self._newsgroups = newsgroups
+		
+		self._segments = SegmentStore()
+		
+		self.logger = logging.getLogger('mangler')
+		self.logger.info('Begin generation of %s', self.filename)
+		
+		self._temppath = self.filepath + '.tmp'
+		self._file = open(self._temppath, 'wb')
+		
+		gentime = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
+		self._file.write('<nzb>')
+		self._file.write(ET.tostring(ET.Comment('Generated by newsmangler v%s at %s' % (NM_VERSION, gentime))))
+	
+	def __len__(self):
+		return len(self._segments)
+	
+	# Remember a posted segment, writing the file out if that was the last one
+	def add(self, fileid, subject, parts, partnum, size, msgid):
+		if self._segments.add(fileid, subject, partnum, size, msgid) == parts:
+			self._write_file(fileid)
+	
+	# Write whatever is left and put the NZB where it belongs
+	def close(self):
+		for fileid in self._segments.fileids():
+			self._write_file(fileid)
+		
+		self._file.write('</nzb>')
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._file.close()
+		
+		os.rename(self._temppath, self.filepath)
+		
+		self.logger.info('End generation of %s', self.filename)
+	
+	def _write_file(self, fileid):
+		subject, posttime, segs = self._segments.pop(fileid)
+		
+		# file
+		f = ET.Element('file',
+			{
+				'poster': self._poster,
+				'date': str(posttime),
+				'subject': subject,
+			}
+		)
+		
+		# newsgroups
+		groups = ET.SubElement(f, 'groups')
+		for newsgroup in self._newsgroups.split(','):
+			group = ET.SubElement(groups, 'group')
+			group.text = newsgroup
+		
+		# segments
+		segments = ET.SubElement(f, 'segments')
+		for partnum, article_size, msgid in segs:
+			segment = ET.SubElement(segments, 'segment',
+				{
+					'bytes': str(article_size),
+					'number': str(partnum),
+				}
+			)
+			segment.text = msgid
+		
+		self._file.write(ET.tostring(f))
+		self._file.flush()
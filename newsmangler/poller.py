@@ -0,0 +1,180 @@
+# Copyright (c) 2005-2012 freddie@wafflemonster.org
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Pollers that block until a socket is ready or a timeout runs out, with the
+same interface as select.poll() except for taking the timeout in seconds."""
+
+import errno
+import select
+import time
+
+# Assume that they need constants
+if not hasattr(select, 'POLLIN'):
+	select.POLLIN = 1
+	select.POLLPRI = 2
+	select.POLLOUT = 4
+	select.POLLERR = 8
+	select.POLLHUP = 16
+	select.POLLNVAL = 32
+
+# ---------------------------------------------------------------------------
+# Use the best poller we have: epoll on Linux, poll() on most other things
+# and select() on Windows.
+def GetPoller():
+	if hasattr(select, 'epoll'):
+		return EpollPoller()
+	elif hasattr(select, 'poll'):
+		return PollPoller()
+	else:
+		return SelectPoller()
+
+# ---------------------------------------------------------------------------
+
+class EpollPoller:
+	name = 'epoll()'
+	
+	def __init__(self):
+		self._epoll = select.epoll()
+		self.FDs = {}
+	
+	# Register an FD for polling, or change what we want to know about. The
+	# EPOLL* flags have the same values as the POLL* ones.
+	def register(self, fd, flags=None):
+		if flags is None:
+			flags = select.POLLIN|select.POLLOUT
+		
+		if fd in self.FDs:
+			if self.FDs[fd] != flags:
+				self._epoll.modify(fd, flags)
+		else:
+			self._epoll.register(fd, flags)
+		self.FDs[fd] = flags
+	
+	# Unregister an FD
+	def unregister(self, fd):
+		del self.FDs[fd]
+		try:
+			self._epoll.unregister(fd)
+		except (IOError, OSError, ValueError):
+			# The socket has already been closed
+			pass
+	
+	# Poll for timeout seconds, or forever if timeout is None
+	def poll(self, timeout=None):
+		if timeout is None:
+			timeout = -1
+		try:
+			return self._epoll.poll(timeout)
+		except IOError, msg:
+			if msg.errno == errno.EINTR:
+				return []
+			raise
+
+# ---------------------------------------------------------------------------
+
+class PollPoller:
+	name = 'poll()'
+	
+	def __init__(self):
+		self._poll = select.poll()
+		self.FDs = {}
+	
+	# Register an FD for polling, or change what we want to know about
+	def register(self, fd, flags=None):
+		if flags is None:
+			flags = select.POLLIN|select.POLLOUT
+		
+		if self.FDs.get(fd) != flags:
+			self._poll.register(fd, flags)
+			self.FDs[fd] = flags
+	
+	# Unregister an FD
+	def unregister(self, fd):
+		del self.FDs[fd]
+		self._poll.unregister(fd)
+	
+	# Poll for timeout seconds, or forever if timeout is None
+	def poll(self, timeout=None):
+		if timeout is not None:
+			timeout = int(timeout * 1000)
+		try:
+			return self._poll.poll(timeout)
+		except select.error, msg:
+			if msg.args[0] == errno.EINTR:
+				return []
+			raise
+
+# ---------------------------------------------------------------------------
+# select() for systems that don't implement poll() (Windows, most notably).
+
+class SelectPoller:
+	name = 'select()'
+	
+	def __init__(self):
+		self.FDs = {}
+	
+	# Register an FD for polling
+	def register(self, fd, flags=None):
+		if flags is None:
+			self.FDs[fd] = select.POLLIN|select.POLLOUT
+		else:
+			self.FDs[fd] = flags
+	
+	# Unregister an FD
+	def unregister(self, fd):
+		del self.FDs[fd]
+	
+	# Poll (select!) for timeout seconds, or forever if timeout is None
+	def poll(self, timeout=None):
+		readers = [fd for fd, flags in self.FDs.items() if flags & select.POLLIN]
+		writers = [fd for fd, flags in self.FDs.items() if flags & select.POLLOUT]
+		
+		# Windows doesn't like select() with nothing to do
+		if not readers and not writers:
+			if timeout:
+				time.sleep(timeout)
+			return []
+		
+		try:
+			can_read, can_write, errored = select.select(readers, writers, readers, timeout)
+		except select.error, msg:
+			if msg.args[0] == errno.EINTR:
+				return []
+			raise
+		
+		results = {}
+		
+		for fd in can_read:
+			results[fd] = select.POLLIN
+		for fd in can_write:
+			results[fd] = results.get(fd, 0) | select.POLLOUT
+		for fd in errored:
+			results[fd] = results.get(fd, 0) | select.POLLERR
+		
+		return results.items()
+
+# ---------------------------------------------------------------------------
@@ -27,35 +27,36 @@
 
 """Main class for posting stuff."""
 
-import asyncore
+import collections
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
-import select
+import signal
+import socket
 import sys
 import time
-import shutil
 
 from cStringIO import StringIO
 
-try:
-    import xml.etree.cElementTree as ET
-except:
-    import xml.etree.ElementTree as ET
-
 from newsmangler import asyncnntp
 from newsmangler import yenc
-from newsmangler.article import Article
+from newsmangler.article import Article, ArticleTable, EncodePart
 from newsmangler.common import *
-from newsmangler.filewrap import FileWrap
+from newsmangler.filewrap import FileWrap, ReadAhead
+from newsmangler.journal import Journal, ReadJournal
+from newsmangler.lease import Channel, LeaseClient, LeaseTable, ParseAddress
+from newsmangler.nzb import NZBWriter
+from newsmangler.poller import GetPoller
 
 # ---------------------------------------------------------------------------
 
 class PostMangler:
-    def __init__(self, conf, debug=False):
+    def __init__(self, conf, debug=False, resume=False, conf_file=None):
         self.conf = conf
-        
-        self._conns = []
-        self._idle = []
+        self._conf_file = conf_file
+        self._resume = resume
         
         # Create our logger
         self.logger = logging.getLogger('mangler')
@@ -68,78 +69,221 @@ class PostMangler:
         else:
             self.logger.setLevel(logging.INFO)
         
-        # Create a poll object for async bits to use. If the user doesn't have
-        # poll, we're going to have to fake it.
-        try:
-            asyncore.poller = select.poll()
-            self.logger.info('Using poll() for sockets')
-        except AttributeError:
-            from newsmangler.fakepoll import FakePoll
-            asyncore.poller = FakePoll()
-            self.logger.info('Using FakePoll() for sockets')
+        # Create our connection pool, and a poll object for it to use
+        self._connpool = asyncnntp.ConnectionPool(self, GetPoller())
+        self.logger.info('Using %s for sockets', self._connpool.poller.name)
 
         self.conf['posting']['skip_filenames'] = self.conf['posting'].get('skip_filenames', '').split()
+        self.conf['posting']['lookahead'] = max(1, self.conf['posting'].get('lookahead', 4))
+        self.conf['posting']['lookahead_memory'] = self.conf['posting'].get('lookahead_memory', 64)
+        self.conf['posting']['encode_workers'] = self.conf['posting'].get('encode_workers', 0)
+        self.conf['posting']['encode_mode'] = self.conf['posting'].get('encode_mode', 'process')
+        self.conf['posting']['read_mode'] = self.conf['posting'].get('read_mode', 'read')
+        self.conf['posting']['readahead'] = self.conf['posting'].get('readahead', 0)
+        self.conf['posting']['journal'] = self.conf['posting'].get('journal', 1)
+        self.conf['posting']['journal_sync'] = float(self.conf['posting'].get('journal_sync', 1))
+        self.conf['posting']['retries'] = self.conf['posting'].get('retries', 3)
+        self.conf['posting']['retry_delay'] = float(self.conf['posting'].get('retry_delay', 5))
+        self.conf['posting']['retry_at_end'] = self.conf['posting'].get('retry_at_end', 0)
+        self.conf['posting']['processes'] = self.conf['posting'].get('processes', 1)
+        self.conf['posting']['lease_size'] = self.conf['posting'].get('lease_size', 100)
+        self.conf['posting']['lease_timeout'] = float(self.conf['posting'].get('lease_timeout', 60))
+        self.conf['posting']['max_rate'] = float(self.conf['posting'].get('max_rate', 0))
+        
+        # [server] and any [server.name] sections are all servers to post to
+        self._servers = []
+        for section in sorted(self.conf.keys()):
+            if section == 'server' or section.startswith('server.'):
+                self._servers.append((section, self.server_defaults(section, self.conf[section])))
+        if not self._servers:
+            print 'ERROR: no [server] section in the config file!'
+            sys.exit(1)
         
-        self._articles = []
+        # Message-IDs use the first server's hostname
+        self._articles = ArticleTable(self._servers[0][1]['hostname'])
+        self._encoded = 0
+        self._encoded_bytes = 0
+        self._pool = None
+        self._pending = collections.deque()
+        self._wakeup = None
+        self._readahead = None
+        self._read_requested = 0
         self._files = {}
-        self._msgids = {}
+        self._nzbs = {}
+        self._journals = {}
+        self._post_parts = {}
+        self._resumed = {}
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._retry_ready = collections.deque()
+        self._retry_bytes = 0
+        
+        # In a shard process, where to send posted articles. In the process
+        # that started them, the shards we're waiting on and how many articles
+        # they have left between them.
+        self._report = None
+        self._shards = {}
+        self._shards_left = 0
+        self._bytes_done = 0
+        
+        # As a worker, the leases we're posting. As a coordinator, the workers.
+        self._leases = None
+        self._workers = {}
+        
+        # Rate limits are split evenly between shards. A SIGHUP makes us read
+        # them from the config file again.
+        self._rate_share = 1
+        self._hangup = False
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.hangup)
+            signal.siginterrupt(signal.SIGHUP, False)
         
-        self._current_dir = None
         self.newsgroup = None
         self.post_title = None
         
         # Some sort of useful logging junk about which yEncode we're using
         self.logger.info('Using %s module for yEnc', yenc.yEncMode())
     
+    # Fill in the options a server section doesn't have to set
+    def server_defaults(self, name, conf):
+        conf['port'] = conf.get('port', 119)
+        conf['username'] = conf.get('username', '')
+        conf['password'] = conf.get('password', '')
+        conf['connections'] = conf.get('connections', 2)
+        conf['reconnect_delay'] = conf.get('reconnect_delay', 5)
+        conf['weight'] = float(conf.get('weight', 1))
+        if conf['weight'] <= 0:
+            print 'ERROR: weight for [%s] has to be more than 0!' % (name)
+            sys.exit(1)
+        conf['streaming'] = conf.get('streaming', 0)
+        conf['stream_window'] = conf.get('stream_window', 8)
+        conf['min_connections'] = conf.get('min_connections', conf['connections'])
+        conf['max_connections'] = conf.get('max_connections', conf['connections'])
+        conf['adapt_interval'] = float(conf.get('adapt_interval', 10))
+        conf['max_rate'] = float(conf.get('max_rate', 0))
+        conf['connect_timeout'] = float(conf.get('connect_timeout', 30))
+        conf['send_timeout'] = float(conf.get('send_timeout', 60))
+        conf['reply_timeout'] = float(conf.get('reply_timeout', 60))
+        return conf
+    
     # -----------------------------------------------------------------------
-    # Connect all of our connections
+    # Connect all of our connections. If we're allowed a range of connections
+    # we start with 'connections' and let the controller find the best number.
     def connect(self):
-        for i in range(self.conf['server']['connections']):
-            conn = asyncnntp.asyncNNTP(self, i, self.conf['server']['hostname'],
-                self.conf['server']['port'], None, self.conf['server']['username'],
-                self.conf['server']['password'],
-            )
-            conn.do_connect()
-            self._conns.append(conn)
+        for name, conf in self._servers:
+            connections = max(conf['min_connections'], min(conf['max_connections'], conf['connections']))
+            server = self._connpool.connect(name, conf, connections)
+            
+            if conf['max_connections'] > conf['min_connections']:
+                server.controller = asyncnntp.ConnectionController(server, conf['min_connections'],
+                    conf['max_connections'], conf['adapt_interval'])
+        
+        self.set_rates()
+    
+    # -----------------------------------------------------------------------
+    # Limit how fast we post, max_rate is in KB/s
+    def set_rates(self):
+        share = float(self._rate_share)
+        if share > 1:
+            log = self.logger.debug
+        else:
+            log = self.logger.info
+        
+        rate = self.conf['posting']['max_rate'] * 1024 / share
+        self._connpool.set_rate(rate)
+        if rate:
+            log('Posting at up to %s/s', NiceSize(rate))
+        
+        for server in self._connpool.servers:
+            rate = server.conf['max_rate'] * 1024 / share
+            self._connpool.set_rate(rate, server)
+            if rate:
+                log('Posting to %s at up to %s/s', server.name, NiceSize(rate))
+    
+    # SIGHUP means the rate limits might have changed. The main loop takes
+    # care of it, all we can do from here is make a note.
+    def hangup(self, signum, frame):
+        self._hangup = True
+    
+    def reload_rates(self):
+        self._hangup = False
+        try:
+            if self._conf_file:
+                conf = ParseConfig(self._conf_file)
+            else:
+                conf = ParseConfig()
+            max_rate = float(conf.get('posting', {}).get('max_rate', 0))
+            server_rates = [float(conf.get(name, {}).get('max_rate', 0)) for name, server_conf in self._servers]
+        except (SystemExit, Exception), msg:
+            self.logger.error("Couldn't read the config file again, rate limits unchanged: %s", msg)
+            return
+        
+        self.conf['posting']['max_rate'] = max_rate
+        for (name, server_conf), rate in zip(self._servers, server_rates):
+            server_conf['max_rate'] = rate
+        self.set_rates()
+        
+        if not self._connpool.shaped:
+            self.logger.info('Posting as fast as we can')
 
     # -----------------------------------------------------------------------
-    # Poll our poll() object and do whatever is neccessary. Basically a combination
-    # of asyncore.poll2() and asyncore.readwrite(), without all the frippery.
-    def poll(self):
-        results = asyncore.poller.poll(0)
-        for fd, flags in results:
-            obj = asyncore.socket_map.get(fd)
-            if obj is None:
-                self.logger.critical('Invalid FD for poll(): %d', fd)
-                asyncore.poller.unregister(fd)
-                continue
-            
-            try:
-                if flags & (select.POLLIN | select.POLLPRI):
-                    obj.handle_read_event()
-                if flags & select.POLLOUT:
-                    obj.handle_write_event()
-                if flags & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
-                    obj.handle_expt_event()
-            except (asyncore.ExitNow, KeyboardInterrupt, SystemExit):
-                raise
-            except:
-                obj.handle_error()
+    # Work out how long we can wait for something to happen before we have to
+    # do something ourselves.
+    def poll_timeout(self, busy, next_stuff):
+        if busy:
+            return 0
+        
+        wake_at = next_stuff
+        reconnect_at = self._connpool.next_timeout()
+        if reconnect_at is not None:
+            wake_at = min(wake_at, reconnect_at)
+        retry_at = self.next_retry()
+        if retry_at is not None:
+            wake_at = min(wake_at, retry_at)
+        
+        # Without a wakeup pipe we have to keep checking on the encoding pool
+        # and read-ahead thread
+        if (self._pending or self._read_requested) and self._wakeup is None:
+            wake_at = min(wake_at, time.time() + 0.01)
+        
+        return max(0, wake_at - time.time())
 
     # -----------------------------------------------------------------------
 
-    def post(self, newsgroup, postme, post_title=None):
+    # Post some stuff. With coordinate, hand the articles out to workers that
+    # connect to that address instead of posting them ourselves.
+    def post(self, newsgroup, postme, post_title=None, coordinate=None):
         self.newsgroup = newsgroup
         self.post_title = post_title
         
         # Generate the list of articles we need to post
         self.generate_article_list(postme)
         
+        # Anything we're resuming that was already finished just needs an NZB
+        for post_title, (total, done) in self._post_parts.items():
+            if done == total:
+                self.logger.info('%s: all %d article(s) already posted', post_title, total)
+                self.finish_post(post_title)
+        
         # If we have no valid articles, bail
         if not self._articles:
-            self.logger.warning('No valid articles to post!')
+            if not self._resume:
+                self.logger.warning('No valid articles to post!')
             return
         
+        if coordinate:
+            self.coordinate(coordinate, postme)
+        elif self.conf['posting']['processes'] > 1:
+            self.post_sharded(self.conf['posting']['processes'])
+        else:
+            self.post_articles()
+    
+    # Post everything in _articles
+    def post_articles(self):
+        # Start our encoding workers before we have any sockets to share
+        self.start_pool()
+        self.start_readahead()
+        
         # Connect!
         self.connect()
 
@@ -149,65 +293,686 @@ class PostMangler:
         
         self.logger.info('Posting %d article(s)...', len(self._articles))
         
+        busy = True
         while 1:
+            # Wait for our sockets to do something, or until it's time to do
+            # something ourselves
+            self._connpool.poll(self.poll_timeout(busy, last_stuff + 0.5))
             now = time.time()
             
-            # Poll our sockets for events
-            self.poll()
+            # Get the next article ready while we wait
+            busy = self.encode_ahead()
+            
+            # Anything that failed earlier might be due another go
+            self.retry_check(now)
             
             # Possibly post some more parts now
-            while self._idle and self._articles:
-                conn = self._idle.pop(0)
-                article = self._articles.pop(0)
+            while self._connpool.idle and self.article_ready():
+                article = self.next_article()
+                if self._leases is not None and self._leases.revoked(article):
+                    article.release()
+                    continue
+                conn = self._connpool.get_idle()
                 conn.post_article(article)
             
+            # Give up on anything that's stuck, and reconnect anything that has
+            # waited long enough
+            self._connpool.stall_check(now)
+            self._connpool.reconnect_check(now)
+            
             # Do some stuff every now and then
             if now - last_stuff >= 0.5:
                 last_stuff = now
                 
-                for conn in self._conns:
-                	conn.reconnect_check(now)
+                for journal in self._journals.values():
+                    journal.check_sync(now)
                 
-                if self._bytes:
+                if self._leases is not None:
+                    self._leases.check(now)
+                
+                if self._hangup:
+                    self.reload_rates()
+                
+                for server in self._connpool.servers:
+                    if server.controller is not None:
+                        server.controller.check(now, server.bytes)
+                
+                if self._report is not None:
+                    self._report.send(('bytes', self._bytes))
+                elif self._bytes:
                     interval = time.time() - start
                     speed = self._bytes / interval / 1024
-                    left = len(self._articles) + (len(self._conns) - len(self._idle))
-                    print '%d article(s) remaining - %.1fKB/s     \r' % (left, speed),
+                    left = self.articles_left() + self._connpool.in_flight()
+                    stalls = self._connpool.stall_count()
+                    if stalls:
+                        print '%d article(s) remaining - %.1fKB/s - %d stall(s)     \r' % (left, speed, stalls),
+                    else:
+                        print '%d article(s) remaining - %.1fKB/s     \r' % (left, speed),
                     sys.stdout.flush()
             
-            # All done?
-            if len(self._articles) == 0 and len(self._idle) == self.conf['server']['connections']:
+            # All done? A worker might be given more to do.
+            if self.articles_left() == 0 and self._connpool.in_flight() == 0 and \
+                (self._leases is None or self._leases.finished()):
                 interval = time.time() - start
                 speed = self._bytes / interval
                 self.logger.info('Posting complete - %s in %s (%s/s)',
                     NiceSize(self._bytes), NiceTime(interval), NiceSize(speed))
+                if len(self._connpool.servers) > 1:
+                    for server in self._connpool.servers:
+                        self.logger.info('%s: %s (%s/s)', server.name, NiceSize(server.bytes),
+                            NiceSize(server.bytes / interval))
+                for server in self._connpool.servers:
+                    if server.stalls:
+                        self.logger.warning('%s: connections stalled %d time(s) - %s', server.name,
+                            sum(server.stalls.values()),
+                            ', '.join(['%d %s' % (n, what) for what, n in sorted(server.stalls.items())]))
+                
+                # Anything that isn't finished yet is missing articles. A shard
+                # leaves that to the process that started it.
+                if self._report is None:
+                    for post_title in self._post_parts.keys():
+                        self.finish_post(post_title)
+                else:
+                    self._report.send(('bytes', self._bytes))
+                
+                break
+        
+        self.stop_readahead()
+        self.stop_pool()
+    
+    # -----------------------------------------------------------------------
+    # Split the articles between a few processes, each posting every nth one
+    # over its share of the connections. We stay behind and keep the journals
+    # and .NZBs up to date with what they tell us.
+    def post_sharded(self, processes):
+        # The shards are forked off with everything we've set up so far
+        if not hasattr(os, 'fork'):
+            self.logger.warning('Posting with more than one process needs fork(), using one')
+            self.post_articles()
+            return
+        
+        # Every process needs at least one connection to each server, and
+        # we can't go over what we're allowed
+        most = min([min(conf['connections'], conf['max_connections']) for name, conf in self._servers])
+        if processes > most:
+            self.logger.warning('Only %d connection(s) allowed, posting with %d process(es)', most, most)
+            processes = most
+            if processes == 1:
+                self.post_articles()
+                return
+        
+        self._shards_left = len(self._articles)
+        self.logger.info('Posting %d article(s) with %d processes...', self._shards_left, processes)
+        
+        self._bytes = 0
+        last_stuff = start = time.time()
+        
+        for index in range(processes):
+            reader, writer = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=self.post_shard, args=(index, processes, writer))
+            proc.start()
+            writer.close()
+            self._shards[reader.fileno()] = [proc, reader, 0]
+        
+        for fd in self._shards.keys():
+            self._connpool.add_reader(fd, lambda fd=fd: self.shard_read(fd))
+        
+        while self._shards:
+            self._connpool.poll(max(0, last_stuff + 0.5 - time.time()))
+            now = time.time()
+            
+            if now - last_stuff >= 0.5:
+                last_stuff = now
+                
+                for journal in self._journals.values():
+                    journal.check_sync(now)
                 
-                # If we have some msgids left over, we might have to generate
-                # a .NZB
-                if self.conf['posting']['generate_nzbs'] and self._msgids:
-                    self.generate_nzb()
+                # Each shard reads the new rate limits for itself
+                if self._hangup:
+                    self._hangup = False
+                    for shard in self._shards.values():
+                        os.kill(shard[0].pid, signal.SIGHUP)
                 
+                self._bytes = sum([shard[2] for shard in self._shards.values()], self._bytes_done)
+                if self._bytes:
+                    speed = self._bytes / (now - start) / 1024
+                    print '%d article(s) remaining - %.1fKB/s     \r' % (self._shards_left, speed),
+                    sys.stdout.flush()
+        
+        self._bytes = self._bytes_done
+        interval = time.time() - start
+        self.logger.info('Posting complete - %s in %s (%s/s)',
+            NiceSize(self._bytes), NiceTime(interval), NiceSize(self._bytes / interval))
+        
+        for post_title in self._post_parts.keys():
+            self.finish_post(post_title)
+    
+    # Something from a shard, or it has gone away
+    def shard_read(self, fd):
+        shard = self._shards[fd]
+        try:
+            message = shard[1].recv()
+        except EOFError:
+            self._connpool.remove_reader(fd)
+            shard[1].close()
+            shard[0].join()
+            if shard[0].exitcode:
+                self.logger.error('Shard process %d exited with %d', shard[0].pid, shard[0].exitcode)
+            
+            self._bytes_done += shard[2]
+            del self._shards[fd]
+            return
+        
+        if message[0] == 'posted':
+            self._shards_left -= 1
+            filewrap, fileinfo, subject = self._articles.file(message[1])
+            self.record_post(fileinfo, subject % (1), *message[2:])
+        elif message[0] == 'failed':
+            self._shards_left -= 1
+        elif message[0] == 'bytes':
+            shard[2] = message[1]
+    
+    # -----------------------------------------------------------------------
+    # Hand out leases on the articles to workers on other hosts, and keep the
+    # journals and .NZBs from what they tell us. The workers have to be able
+    # to see the files with the same paths we do.
+    def coordinate(self, address, postme):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(ParseAddress(address))
+        listener.listen(16)
+        
+        table = LeaseTable(self._articles.parts(), self.conf['posting']['lease_size'],
+            self.conf['posting']['lease_timeout'])
+        
+        # What a worker needs to come up with the same list of articles
+        job = {
+            'cmd': 'job',
+            'newsgroup': self.newsgroup,
+            'post_title': self.post_title,
+            'postme': [os.path.abspath(p) for p in postme],
+            'posting': dict([(k, self.conf['posting'][k]) for k in ('from', 'article_size', 'subject_prefix', 'skip_filenames')]),
+            'files': [(fileinfo['filepath'], fileinfo['filesize']) for filewrap, fileinfo, subject in self._articles.files()],
+        }
+        
+        def accept():
+            sock, addr = listener.accept()
+            channel = Channel(sock, '%s:%d' % addr)
+            self._workers[channel.fileno()] = [channel, 0]
+            self._connpool.add_reader(channel.fileno(), lambda fd=channel.fileno(): self.worker_read(fd, table, job))
+        self._connpool.add_reader(listener.fileno(), accept)
+        
+        total = len(table)
+        self.logger.info('Waiting for workers on %s to post %d article(s)...', address, total)
+        
+        self._bytes = 0
+        last_stuff = start = time.time()
+        
+        while not table.finished():
+            self._connpool.poll(max(0, last_stuff + 0.5 - time.time()))
+            now = time.time()
+            
+            if now - last_stuff >= 0.5:
+                last_stuff = now
+                
+                for lease in table.expire(now):
+                    self.logger.warning('Lease %d was not renewed, handing it out again', lease.id)
+                
+                for journal in self._journals.values():
+                    journal.check_sync(now)
+                
+                self._bytes = sum([worker[1] for worker in self._workers.values()], self._bytes_done)
+                if self._bytes:
+                    speed = self._bytes / (now - start) / 1024
+                    print '%d article(s) remaining - %.1fKB/s     \r' % (len(table), speed),
+                    sys.stdout.flush()
+        
+        # Tell everyone we're done
+        self._connpool.remove_reader(listener.fileno())
+        listener.close()
+        for fd, (channel, nbytes) in self._workers.items():
+            try:
+                channel.send({'cmd': 'finished'})
+            except IOError:
+                pass
+        
+        interval = time.time() - start
+        self._bytes = sum([worker[1] for worker in self._workers.values()], self._bytes_done)
+        self.logger.info('Posting complete - %s in %s (%s/s)',
+            NiceSize(self._bytes), NiceTime(interval), NiceSize(self._bytes / interval))
+        
+        for post_title in self._post_parts.keys():
+            self.finish_post(post_title)
+    
+    # Something from a worker, or it has gone away
+    def worker_read(self, fd, table, job):
+        worker = self._workers[fd]
+        channel = worker[0]
+        try:
+            self.worker_messages(worker, table, job)
+        except (EOFError, IOError, ValueError, KeyError, TypeError), msg:
+            if msg.args:
+                self.logger.warning('Dropping worker %s: %s', channel.name, msg)
+            else:
+                self.logger.info('Worker %s has gone away', channel.name)
+            table.release(channel.name)
+            self._connpool.remove_reader(fd)
+            channel.close()
+            self._bytes_done += worker[1]
+            del self._workers[fd]
+    
+    # Deal with whatever a worker sent us. A worker that goes away while we're
+    # answering, or sends something we don't understand, ends up as an
+    # exception for worker_read().
+    def worker_messages(self, worker, table, job):
+        channel = worker[0]
+        for message in channel.read():
+            cmd = message['cmd']
+            if cmd == 'hello':
+                self.logger.info('Worker %s (%s) says hello', channel.name, message['name'])
+                channel.send(job)
+            
+            elif cmd == 'lease':
+                lease = table.grant(channel.name, time.time())
+                if lease is not None:
+                    channel.send({'cmd': 'lease', 'lease': lease.id, 'parts': sorted(lease.parts),
+                        'timeout': table.timeout})
+                elif table.finished():
+                    channel.send({'cmd': 'finished'})
+                else:
+                    channel.send({'cmd': 'wait'})
+            
+            elif cmd == 'renew':
+                revoked = table.renew(message['leases'], channel.name, time.time())
+                if revoked:
+                    channel.send({'cmd': 'revoke', 'leases': revoked})
+            
+            elif cmd == 'posted':
+                part = tuple(message['part'])
+                if table.posted(part):
+                    filewrap, fileinfo, subject = self._articles.file(part[0])
+                    self.record_post(fileinfo, subject % (1), part[1], message['size'], message['msgid'])
+            
+            elif cmd == 'failed':
+                table.failed(tuple(message['part']))
+            
+            elif cmd == 'bytes':
+                worker[1] = message['bytes']
+    
+    # Post whatever a coordinator gives us
+    def work(self, address):
+        channel = Channel(socket.create_connection(ParseAddress(address), 30), address)
+        channel.send({'cmd': 'hello', 'name': '%s:%d' % (socket.gethostname(), os.getpid())})
+        job = channel.wait()
+        
+        # Use the coordinator's idea of what the articles look like, and make
+        # sure we end up with the same files it has
+        self.newsgroup = job['newsgroup']
+        self.post_title = job['post_title']
+        self.conf['posting'].update(job['posting'])
+        self.generate_article_list(job['postme'])
+        
+        files = [[fileinfo['filepath'], fileinfo['filesize']] for filewrap, fileinfo, subject in self._articles.files()]
+        if files != job['files']:
+            self.logger.error("Our files don't match the coordinator's!")
+            channel.close()
+            return
+        
+        self.logger.info('Working for the coordinator at %s', address)
+        
+        self._articles.clear()
+        self._leases = self._report = LeaseClient(channel, self._articles, self._connpool)
+        self._connpool.add_reader(channel.fileno(), self._leases.read)
+        self._leases.check(time.time())
+        
+        self.post_articles()
+        channel.close()
+    
+    # Post our share of the articles. This runs in its own process, so it
+    # needs its own connections and poller.
+    def post_shard(self, index, count, report):
+        self._report = report
+        self._connpool = asyncnntp.ConnectionPool(self, GetPoller())
+        self._articles.shard(index, count)
+        self._rate_share = count
+        
+        # post_sharded() made sure there are enough connections to go round,
+        # only min_connections can come out at less than one
+        for name, conf in self._servers:
+            for key in ('connections', 'min_connections', 'max_connections'):
+                conf[key] = max(1, conf[key] // count + (index < conf[key] % count))
+        
+        if self._articles:
+            self.post_articles()
+        report.close()
+    
+    # -----------------------------------------------------------------------
+    # Start a pool of threads or processes to encode articles with, if wanted
+    def start_pool(self):
+        workers = self.conf['posting']['encode_workers']
+        if not workers:
+            return
+        
+        if self.conf['posting']['encode_mode'] == 'thread':
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(workers)
+        else:
+            from multiprocessing import Pool
+            self._pool = Pool(workers)
+        
+        self.start_wakeup()
+        
+        self.logger.info('Encoding with %d worker %s(s)', workers, self.conf['posting']['encode_mode'])
+    
+    def stop_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pending.clear()
+        
+        self.stop_wakeup()
+    
+    # Start a thread to read parts ahead of time, if wanted. Encoding workers and
+    # mmap do their own reading, so it's only any use when encoding in the main
+    # loop.
+    def start_readahead(self):
+        buffers = self.conf['posting']['readahead']
+        if not buffers or self._pool is not None or self.conf['posting']['read_mode'] not in ('read', 'nocache'):
+            return
+        
+        self.start_wakeup()
+        self._readahead = ReadAhead(buffers, self.conf['posting']['article_size'], self.wake,
+            nocache=(self.conf['posting']['read_mode'] == 'nocache'))
+        for filewrap in self._files.values():
+            filewrap.readahead = self._readahead
+        
+        self.logger.info('Reading ahead with %d buffer(s)', buffers)
+    
+    def stop_readahead(self):
+        if self._readahead is not None:
+            self._readahead.stop()
+            for filewrap in self._files.values():
+                filewrap.readahead = None
+            self._readahead = None
+            self._read_requested = 0
+        
+        self.stop_wakeup()
+    
+    # Ask the read-ahead thread for the next few articles after the ones we've
+    # already encoded. Everything before _read_requested has been asked for, so
+    # they get taken in the same order.
+    def read_ahead(self):
+        if self._readahead is None:
+            return
+        
+        want = min(len(self._articles), self._encoded + self._readahead.buffers)
+        while self._read_requested < want:
+            article = self._articles[self._read_requested]
+            self._readahead.want(article._fileinfo['filepath'], article._begin, article._end)
+            self._read_requested += 1
+    
+    # -----------------------------------------------------------------------
+    # Workers and the read-ahead thread wake the main loop up through a pipe
+    # when they're done. select() on Windows only works on sockets, so there we
+    # just have to keep checking.
+    def start_wakeup(self):
+        if self._wakeup is not None:
+            return
+        
+        try:
+            import fcntl
+        except ImportError:
+            pass
+        else:
+            self._wakeup = os.pipe()
+            for fd in self._wakeup:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._connpool.add_reader(self._wakeup[0], self.encode_wakeup)
+    
+    def stop_wakeup(self):
+        if self._wakeup is not None:
+            self._connpool.remove_reader(self._wakeup[0])
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+    
+    # An encoding worker finished, we just needed to wake up
+    def encode_wakeup(self):
+        try:
+            os.read(self._wakeup[0], 4096)
+        except OSError:
+            pass
+    
+    # Called from the pool's result thread when an article has been encoded
+    def encode_done(self, result):
+        self.wake()
+    
+    # Wake the main loop up, from another thread
+    def wake(self):
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], '.')
+            except OSError:
+                # The pipe is full, the main loop will wake up anyway
+                pass
+    
+    # -----------------------------------------------------------------------
+    # Encode the next few articles ahead of time so that the POST handler only
+    # has to start sending them. Without an encoding pool this only does one
+    # article per call so the sockets aren't kept waiting. Returns True if
+    # there was something to do.
+    def encode_ahead(self):
+        self.read_ahead()
+        
+        # Retries that had to let go of their data go first
+        for entry in self._retry_ready:
+            article, result = entry
+            if article.is_encoded() or result is not None:
+                continue
+            if self._pool is None:
+                article.encode()
+                return True
+            entry[1] = self._pool.apply_async(EncodePart,
+                article.encode_args(as_string=(self.conf['posting']['encode_mode'] != 'thread')),
+                callback=self.encode_done)
+        
+        # There's always room for one, or nothing would ever get posted
+        busy = False
+        while self._encoded < min(len(self._articles), self.conf['posting']['lookahead']):
+            if self._encoded and self.encoded_bytes() >= self.lookahead_memory():
                 break
             
-            # And sleep for a bit to try and cut CPU chompage
-            time.sleep(0.01)
+            article = self._articles[self._encoded]
+            if self._pool is None:
+                # Don't wait on the disk if the read-ahead thread isn't done yet
+                if self._readahead is not None and not self._readahead.ready(article._fileinfo['filepath'], article._begin):
+                    break
+                article.encode()
+            else:
+                self._pending.append(self._pool.apply_async(EncodePart,
+                    article.encode_args(as_string=(self.conf['posting']['encode_mode'] != 'thread')),
+                    callback=self.encode_done))
+            
+            self._encoded += 1
+            self._encoded_bytes += article._end - article._begin
+            busy = True
+            
+            if self._pool is None:
+                break
+        
+        return busy
+    
+    # Is the next article ready to post? Articles are handed out in order, so
+    # we wait for the pool to finish this one even if later ones are done.
+    # Retries go first, they've been waiting long enough.
+    def article_ready(self):
+        if self._retry_ready:
+            article, result = self._retry_ready[0]
+            if result is not None:
+                return result.ready()
+            return article.is_encoded()
+        if not self._articles:
+            return False
+        if self._pool is None:
+            return True
+        return bool(self._pending) and self._pending[0].ready()
+    
+    # Take the next article off the list, encoding it now if we didn't manage
+    # to do it ahead of time. Retries that still have their encoded data just
+    # get posted again, the rest are encoded when the connection prepares them.
+    def next_article(self):
+        if self._retry_ready:
+            article, result = self._retry_ready.popleft()
+            if result is not None:
+                article.encoded(result.get())
+            self._retry_bytes -= article._end - article._begin
+            return article
+        
+        article = self._articles.popleft()
+        if self._read_requested:
+            self._read_requested -= 1
+        if self._encoded:
+            self._encoded -= 1
+            self._encoded_bytes -= article._end - article._begin
+            if self._pool is not None:
+                article.encoded(self._pending.popleft().get())
+        else:
+            article.encode()
+        return article
+    
+    # -----------------------------------------------------------------------
+    # An article was posted successfully
+    def post_success(self, article):
+        if self._report is not None:
+            self._report.send(('posted', article._fileinfo['fileid'], article._partnum, article.size,
+                article.headers['Message-ID']))
+        else:
+            self.record_post(article._fileinfo, article._subject % (1), article._partnum, article.size,
+                article.headers['Message-ID'])
+    
+    # Put a posted article in the journal and the .NZB, finishing the post if
+    # that was the last one
+    def record_post(self, fileinfo, subject, partnum, size, msgid):
+        post_title = fileinfo['dirname']
+        post_parts = self._post_parts[post_title]
+        post_parts[1] += 1
+        
+        if self.conf['posting']['journal']:
+            journal = self._journals.get(post_title)
+            if journal is None:
+                journal = self._journals[post_title] = Journal(self.journal_path(post_title),
+                    self.conf['posting']['journal_sync'])
+            journal.add(fileinfo['filepath'], partnum, size, msgid)
+        
+        self.remember_msgid(fileinfo, subject, partnum, size, msgid)
+        
+        if post_parts[1] == post_parts[0]:
+            self.finish_post(post_title)
+    
+    # An article didn't make it. Put it back in the queue to try again later,
+    # waiting twice as long each time, unless it has run out of retries. Those
+    # are left out of the NZB and the journal, so --resume can have a go.
+    def post_failed(self, article, reason, retry=True):
+        article.attempts += 1
+        if not retry or article.attempts > self.conf['posting']['retries']:
+            self.logger.error('%s part %d: giving up after %d attempt(s) - %s',
+                article._fileinfo['filename'], article._partnum, article.attempts, reason)
+            article.release()
+            if self._report is not None:
+                self._report.send(('failed', article._fileinfo['fileid'], article._partnum))
+            return
+        
+        delay = self.conf['posting']['retry_delay'] * 2 ** (article.attempts - 1)
+        self.logger.info('%s part %d: retrying in %.1fs', article._fileinfo['filename'],
+            article._partnum, delay)
+        
+        # The last attempt might have got there after all, a new Message-ID
+        # stops the server rejecting this one as a duplicate
+        article.headers['Message-ID'] = self._articles.new_msgid(article._partnum)
+        
+        # Articles waiting for the end of the post could be around for a while,
+        # and the encoded data counts against lookahead_memory. Anything we
+        # can't keep is encoded again when it's due.
+        size = article._end - article._begin
+        if self.conf['posting']['retry_at_end'] or not article.is_encoded() or \
+            self.encoded_bytes() + size > self.lookahead_memory():
+            article.release()
+        else:
+            self._retry_bytes += size
+        
+        heapq.heappush(self._retries, (time.time() + delay, self._retry_seq.next(), article))
+    
+    # When the next retry is due, or None. One that has to be encoded again
+    # waits for memory if other retries are still queued up.
+    def next_retry(self):
+        if not self._retries:
+            return None
+        if self.conf['posting']['retry_at_end'] and self._articles:
+            return None
+        
+        article = self._retries[0][2]
+        if not article.is_encoded() and self._retry_ready and \
+            self.encoded_bytes() + article._end - article._begin > self.lookahead_memory():
+            return None
+        return self._retries[0][0]
+    
+    # Move any retries that are due to the front of the queue, encode_ahead()
+    # takes care of any that need encoding again
+    def retry_check(self, now):
+        retry_at = self.next_retry()
+        while retry_at is not None and retry_at <= now:
+            article = heapq.heappop(self._retries)[2]
+            if not article.is_encoded():
+                self._retry_bytes += article._end - article._begin
+            self._retry_ready.append([article, None])
+            retry_at = self.next_retry()
+    
+    # Memory used by encoded articles, lookahead and retries
+    def encoded_bytes(self):
+        return self._encoded_bytes + self._retry_bytes
+    
+    def lookahead_memory(self):
+        return self.conf['posting']['lookahead_memory'] * 1024 * 1024
+    
+    # How many articles still have to be posted
+    def articles_left(self):
+        return len(self._articles) + len(self._retries) + len(self._retry_ready)
+    
+    def journal_path(self, post_title):
+        return '%s.journal' % (SafeFilename(post_title))
+    
+    # Done with a post. If everything made it we don't need the journal any
+    # more, otherwise keep it around for --resume.
+    def finish_post(self, post_title):
+        total, done = self._post_parts.pop(post_title)
+        
+        # Everything was in the journal already, write the NZB from that
+        if self._resumed.get(post_title) and self.conf['posting']['generate_nzbs']:
+            self.start_nzb(post_title)
+        self.finish_nzb(post_title)
+        
+        journal = self._journals.pop(post_title, None)
+        if done == total:
+            if journal is not None:
+                journal.remove()
+            elif os.path.isfile(self.journal_path(post_title)):
+                os.remove(self.journal_path(post_title))
+        else:
+            if journal is not None:
+                journal.close()
+            self.logger.warning('%s: %d of %d article(s) not posted, use --resume to try again',
+                post_title, total - done, total)
     
     # -----------------------------------------------------------------------
     # Maybe remember the msgid for later
-    def remember_msgid(self, article_size, article):
+    def remember_msgid(self, fileinfo, subject, partnum, size, msgid):
         if self.conf['posting']['generate_nzbs']:
-            if self._current_dir != article._fileinfo['dirname']:
-                if self._msgids:
-                    self.generate_nzb()
-                    self._msgids = {}
-                
-                self._current_dir = article._fileinfo['dirname']
+            nzb = self._nzbs.get(fileinfo['dirname'])
+            if nzb is None:
+                nzb = self.start_nzb(fileinfo['dirname'])
             
-            subj = article._subject % (1)
-            if subj not in self._msgids:
-                self._msgids[subj] = [int(time.time())]
-            #self._msgids[subj].append((article.headers['Message-ID'], article_size))
-            self._msgids[subj].append((article, article_size))
+            nzb.add(fileinfo['fileid'], subject, fileinfo['parts'], partnum, size, msgid)
     
     # -----------------------------------------------------------------------
     # Generate the list of articles we need to post
@@ -235,22 +1000,44 @@ class PostMangler:
                 continue
             if filename in self.conf['posting']['skip_filenames'] or filename == '.newsmangler':
                 continue
-            filesize = os.path.getsize(filepath)
-            if filesize == 0:
+            st = os.stat(filepath)
+            if st.st_size == 0:
                 continue
             
-            goodfiles.append((filepath, filename, filesize))
+            goodfiles.append((filepath, filename, st.st_size, st.st_dev))
         
         goodfiles.sort()
         
+        # Files on each device, in order
+        devices = collections.OrderedDict()
+        
+        # See what we managed to post last time
+        journaled = {}
+        if self._resume and os.path.isfile(self.journal_path(post_title)):
+            journaled = ReadJournal(self.journal_path(post_title))
+            self.logger.info('%s: resuming from %s', post_title, self.journal_path(post_title))
+        
+        total = done = 0
+        resumed = []
+        
+        # Headers that are the same for every article, blank line included
+        headers = 'From: %s\r\nNewsgroups: %s\r\nPath: not-for-mail\r\nX-Newsposter: newsmangler %s (%s) - https://github.com/madcowfred/newsmangler\r\n\r\n' % (
+            self.conf['posting']['from'], self.newsgroup, NM_VERSION, yenc.yEncMode())
+        
         # Do stuff with files
         n = 1
-        for filepath, filename, filesize in goodfiles:
+        for filepath, filename, filesize, device in goodfiles:
             parts, partial = divmod(filesize, article_size)
             if partial:
                 parts += 1
             
-            self._files[filepath] = FileWrap(filepath, parts)
+            # Skip anything that's in the journal
+            posted = {}
+            for partnum, size, msgid in journaled.get(filepath, []):
+                posted[partnum] = (size, msgid)
+            partnums = [partnum for partnum in xrange(1, parts + 1) if partnum not in posted]
+            
+            self._files[filepath] = FileWrap(filepath, len(partnums), self.conf['posting']['read_mode'])
 
             # Build a subject
             real_filename = os.path.split(filename)[1]
@@ -266,32 +1053,58 @@ class PostMangler:
             if self.conf['posting']['subject_prefix']:
                 subject = '%s %s' % (self.conf['posting']['subject_prefix'], subject)
             
-            # Now make up our parts
+            # Now make up our parts, the articles themselves are only built
+            # when we get around to posting them
             fileinfo = {
                 'dirname': post_title,
                 'filename': real_filename,
                 'filepath': filepath,
                 'filesize': filesize,
                 'parts': parts,
+                'article_size': article_size,
+                'headers': headers,
+                'ybegin': ' total=%d line=128 size=%d name=%s\r\n' % (parts, filesize, real_filename),
             }
             
-            for i in range(parts):
-                partnum = i + 1
-                begin = 0 + (i * article_size)
-                end = min(filesize, partnum * article_size)
-                
-                # Build the article
-                art = Article(self._files[filepath], begin, end, fileinfo, subject, partnum)
-                art.headers['From'] = self.conf['posting']['from']
-                art.headers['Newsgroups'] = self.newsgroup
-                art.headers['Subject'] = subject % (partnum)
-                art.headers['Message-ID'] = '<%.5f.%d@%s>' % (time.time(), partnum, self.conf['server']['hostname'])
-                art.headers['X-Newsposter'] = 'newsmangler %s (%s) - https://github.com/madcowfred/newsmangler\r\n' % (
-                    NM_VERSION, yenc.yEncMode())
-
-                self._articles.append(art)
+            fileid = fileinfo['fileid'] = self._articles.add_file(self._files[filepath], fileinfo, subject)
+            devices.setdefault(device, []).append((fileid, partnums))
+            
+            for partnum, (size, msgid) in sorted(posted.items()):
+                if partnum <= parts:
+                    resumed.append((fileinfo, subject % (1), partnum, size, msgid))
             
+            total += parts
             n += 1
+        
+        self._post_parts[post_title] = [total, len(resumed)]
+        if resumed:
+            self._resumed[post_title] = resumed
+        
+        # If the files are spread over more than one disk, take turns between
+        # them so they're all busy. Each file is still read in order.
+        if len(devices) > 1:
+            self.logger.info('%s: interleaving articles from %d devices', post_title, len(devices))
+            self._interleave(devices.values())
+        else:
+            for files in devices.values():
+                for fileid, partnums in files:
+                    self._articles.add_parts(fileid, partnums)
+    
+    # Add the parts of each list of files to the article table, taking one part
+    # from each list in turn
+    def _interleave(self, lists):
+        parts = [self._iter_parts(files) for files in lists]
+        while parts:
+            for it in parts[:]:
+                try:
+                    self._articles.add_parts(*it.next())
+                except StopIteration:
+                    parts.remove(it)
+    
+    def _iter_parts(self, files):
+        for fileid, partnums in files:
+            for partnum in partnums:
+                yield fileid, (partnum,)
     
     # -----------------------------------------------------------------------
     # Build an article for posting.
@@ -315,67 +1128,37 @@ class PostMangler:
         art.headers['From'] = self.conf['posting']['from']
         art.headers['Newsgroups'] = self.newsgroup
         art.headers['Subject'] = subject % (partnum)
-        art.headers['Message-ID'] = '<%.5f.%d@%s>' % (time.time(), partnum, self.conf['server']['hostname'])
+        art.headers['Message-ID'] = '<%.5f.%d@%s>' % (time.time(), partnum, self._servers[0][1]['hostname'])
         art.headers['X-Newsposter'] = 'newsmangler %s (%s) - https://github.com/madcowfred/newsmangler\r\n' % (
             NM_VERSION, yenc.yEncMode())
 
         self._articles.append(art)
     
     # -----------------------------------------------------------------------
-    # Generate a .NZB file!
-    def generate_nzb(self):
-        filename = '%s.nzb' % (SafeFilename(self._current_dir))
-
-        self.logger.info('Begin generation of %s', filename)
-
-        gentime = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
-        root = ET.Element('nzb')
-        root.append(ET.Comment('Generated by newsmangler v%s at %s' % (NM_VERSION, gentime)))
-
-        for subject, msgids in self._msgids.items():
-            posttime = msgids.pop(0)
-
-            # file
-            f = ET.SubElement(root, 'file',
-                {
-                    'poster': self.conf['posting']['from'],
-                    'date': str(posttime),
-                    'subject': subject,
-                }
-            )
-
-            # newsgroups
-            groups = ET.SubElement(f, 'groups')
-            for newsgroup in self.newsgroup.split(','):
-                group = ET.SubElement(groups, 'group')
-                group.text = newsgroup
-
-            # segments
-            segments = ET.SubElement(f, 'segments')
-            temp = [(m._partnum, m, article_size) for m, article_size in msgids]
-            temp.sort()
-            for partnum, article, article_size in temp:
-                segment = ET.SubElement(segments, 'segment',
-                    {
-                        'bytes': str(article_size),
-                        'number': str(partnum),
-                    }
-                )
-                segment.text = str(article.headers['Message-ID'][1:-1])
-
-        with open(filename, 'w') as nzbfile:
-            ET.ElementTree(root).write(nzbfile, xml_declaration=True)
+    # Start a new .NZB file for a post, it gets written as we go
+    def start_nzb(self, post_title):
+        filename = '%s.nzb' % (SafeFilename(post_title))
+        
+        # Write it straight into the final folder if we have one, so that it
+        # can be renamed into place when it's done
+        folder = self.conf['posting']['final_folder']
+        if folder and not os.path.isdir(folder):
+            self.logger.warning('final_folder %s does not exist, writing %s here instead', folder, filename)
+            folder = None
+        
+        nzb = self._nzbs[post_title] = NZBWriter(filename, folder or '.', self.conf['posting']['from'],
+            self.newsgroup)
+        
+        # Put back anything we're resuming
+        for fileinfo, subject, partnum, size, msgid in self._resumed.pop(post_title, []):
+            nzb.add(fileinfo['fileid'], subject, fileinfo['parts'], partnum, size, msgid)
+        
+        return nzb
+    
+    # Finish off a post's .NZB file
+    def finish_nzb(self, post_title):
+        nzb = self._nzbs.pop(post_title, None)
+        if nzb is not None:
+            nzb.close()
 
-        self.logger.info('End generation of %s', filename)
-	
-	#Copying NZB to different location
-	end_folder = self.conf['posting']['final_folder']
-	if end_folder:
-	    self.logger.info('Copying NZB file, %s, to config defined location,', end_folder)
-	    endNzb = os.path.join(end_folder, filename)
-	    shutil.copyfile(filename, endNzb)
-	    if os.path.isfile(endNzb):
-	       self.logger.info('Finished copying NZB file')
-	       os.remove(filename)
-	       self.logger.info('Deleteing original NZB file after copied')
 # ---------------------------------------------------------------------------
@@ -32,6 +32,7 @@ import zlib
 
 # ---------------------------------------------------------------------------
 
+HAVE_NUMPY = False
 HAVE_PSYCO = False
 HAVE_YENC = False
 HAVE_YENC_FRED = False
@@ -40,6 +41,13 @@ HAVE_YENC_FRED = False
 # Translation tables
 YDEC_TRANS = ''.join([chr((i + 256 - 42) % 256) for i in range(256)])
 YENC_TRANS = ''.join([chr((i + 42) % 256) for i in range(256)])
+CRLF = (13, 10)
+
+# Bytes that end up as =, NUL, LF, CR once translated
+YENC_CRITICAL = [chr((i + 256 - 42) % 256) for i in (61, 0, 10, 13)]
+
+# How much input yEncode_Stream translates at a time
+STREAM_READ_SIZE = 16384
 
 YDEC_MAP = {}
 for i in range(256):
@@ -56,6 +64,10 @@ def yunescape(m):
 	return YDEC_MAP[m.group(1)]
 
 def yEncode_C(postfile, data):
+	# _yenc only takes strings, so mmap buffers get copied here
+	if not isinstance(data, str):
+		data = str(data)
+	
 	# If we don't have my modified yenc module, we have to do the . quoting
 	# ourselves. This is about 50% slower.
 	if HAVE_YENC_FRED:
@@ -74,6 +86,8 @@ def yEncode_C(postfile, data):
 def yEncode_Python(postfile, data, linelen=128):
 	'Encode data into yEnc format'
 	
+	if not isinstance(data, str):
+		data = str(data)
 	translated = data.translate(YENC_TRANS)
 	
 	# escape =, NUL, LF, CR
@@ -117,6 +131,200 @@ def yEncode_Python(postfile, data, linelen=128):
 	
 	return CRC32(data)
 
+def yEncode_Stream(outbuf, data, offset=0, linelen=128):
+	'''Encode data into yEnc format, writing straight into outbuf (a bytearray
+	or writable memoryview, see yEncBound()) at offset. Returns the offset of
+	the end of the encoded data and the CRC32 of data.'''
+	
+	crc = 0
+	pos = 0
+	translated = ''
+	start = 0
+	datalen = 0
+	
+	while True:
+		# Translate some more data once we're running low, we need a full line
+		# plus one character to be sure where the line ends.
+		if datalen - start <= linelen and pos < len(data):
+			chunk = data[pos:pos + STREAM_READ_SIZE]
+			pos += len(chunk)
+			crc = zlib.crc32(chunk, crc)
+			
+			chunk = chunk.translate(YENC_TRANS)
+			# escape =, NUL, LF, CR
+			for i in (61, 0, 10, 13):
+				chunk = chunk.replace(chr(i), '=%c' % (i + 64))
+			
+			translated = translated[start:] + chunk
+			start = 0
+			datalen = len(translated)
+			continue
+		
+		if start == datalen:
+			break
+		
+		end = min(datalen, start + linelen)
+		line = translated[start:end]
+		
+		# a line consisting entirely of a space/tab/period
+		if start == end - 1:
+			if line in ('\x09', '\x20'):
+				line = '=%c' % (ord(line) + 64)
+			elif line == '\x2e':
+				line = '..'
+		else:
+			# escape tab/space/period at the start of a line
+			if line[0] in ('\x09', '\x20'):
+				line = '=%c%s' % (ord(line[0]) + 64, line[1:-1])
+				end -= 1
+			elif line[0] == '\x2e':
+				line = '.%s' % (line)
+			
+			# escaped char on the end of the line
+			if line[-1] == '=':
+				line += translated[end]
+				end += 1
+			# escape tab/space at the end of a line
+			elif line[-1] in ('\x09', '\x20'):
+				line = '%s=%c' % (line[:-1], ord(line[-1]) + 64)
+		
+		line += '\r\n'
+		outbuf[offset:offset + len(line)] = line
+		offset += len(line)
+		start = end
+	
+	return offset, '%08x' % (crc & 2**32L - 1)
+
+class BufferWriter:
+	'File-like object that writes into a bytearray or memoryview'
+	def __init__(self, outbuf, offset=0):
+		self.outbuf = outbuf
+		self.offset = offset
+	
+	def write(self, data):
+		self.outbuf[self.offset:self.offset + len(data)] = data
+		self.offset += len(data)
+
+def yEncodeInto_Writer(outbuf, data, offset=0):
+	'yEncodeInto() for the yEncode() implementations that want a file object'
+	writer = BufferWriter(outbuf, offset)
+	crc = yEncode(writer, data)
+	return writer.offset, crc
+
+def yEncBound(data, linelen=128):
+	'Return the most bytes yEncode_Stream() could write when encoding data'
+	escaped = len(data)
+	if isinstance(data, str):
+		escaped += sum([data.count(c) for c in YENC_CRITICAL])
+	else:
+		# buffers don't have count(), do it a bit at a time to avoid copying
+		# the whole thing
+		for pos in xrange(0, len(data), STREAM_READ_SIZE):
+			chunk = data[pos:pos + STREAM_READ_SIZE]
+			escaped += sum([chunk.count(c) for c in YENC_CRITICAL])
+	# Every line but the last two uses at least linelen - 1 escaped bytes, and
+	# can grow by a period or escape at each end plus the CRLF.
+	return escaped + (escaped // (linelen - 1) + 2) * 4
+
+def yEncode_NumPy(postfile, data, linelen=128):
+	'Encode data into yEnc format, using NumPy to work on the whole part at once'
+	
+	if not data:
+		return CRC32(data)
+	
+	# translate and escape =, NUL, LF, CR
+	shifted = numpy.frombuffer(data, dtype=numpy.uint8) + numpy.uint8(42)
+	critical = (shifted == 61) | (shifted == 0) | (shifted == 10) | (shifted == 13)
+	shifted += critical.view(numpy.uint8) << 6
+	escaped = _yInsert(shifted, numpy.flatnonzero(critical), 61)
+	datalen = len(escaped)
+	
+	# A line only needs looking at if it starts with a tab/space/period, or ends
+	# with an escape or a tab/space. Mark every position where a line starting
+	# there would need it.
+	whitespace = (escaped == 9) | (escaped == 32)
+	special = whitespace | (escaped == 46)
+	if datalen >= linelen:
+		special[:datalen - linelen + 1] |= whitespace[linelen - 1:] | (escaped[linelen - 1:] == 61)
+	
+	# Find the line endings, plus anything we have to insert at the start or end
+	# of a line. Runs of plain lines are done in one go, the rest one at a time
+	# since escaping the first or last character moves the next line's start.
+	translated = escaped.tobytes()
+	crlf = numpy.tile(numpy.array(CRLF, dtype=numpy.uint8), datalen // linelen + 1)
+	bump = []
+	insert_at = []
+	insert_chars = []
+	start = 0
+	
+	while start < datalen:
+		# skip over plain lines, the last line is always done the slow way
+		starts = special[start:max(start, datalen - linelen):linelen]
+		plain = len(starts)
+		if plain:
+			special_at = starts.argmax()
+			if starts[special_at]:
+				plain = special_at
+		if plain:
+			ends = numpy.arange(start + linelen, start + (plain + 1) * linelen, linelen)
+			insert_at.append(ends.repeat(2))
+			insert_chars.append(crlf[:plain * 2])
+			start += plain * linelen
+		
+		end = min(datalen, start + linelen)
+		first = translated[start]
+		
+		# a line of one character, escaped the same way yEncode_Python does it
+		if start == end - 1:
+			if first in ('\x09', '\x20'):
+				bump.append(start)
+				insert_at.append((start,))
+				insert_chars.append((61,))
+		else:
+			# escape tab/space/period at the start of a line
+			if first in ('\x09', '\x20'):
+				bump.append(start)
+				insert_at.append((start,))
+				insert_chars.append((61,))
+				end -= 1
+			elif first == '\x2e':
+				insert_at.append((start,))
+				insert_chars.append((46,))
+			
+			# a two character line that started with a tab/space is done now
+			if end > start + 1 or first not in ('\x09', '\x20'):
+				last = translated[end - 1]
+				# escaped char on the end of the line
+				if last == '=':
+					end += 1
+				# escape tab/space at the end of a line
+				elif last in ('\x09', '\x20'):
+					bump.append(end - 1)
+					insert_at.append((end - 1,))
+					insert_chars.append((61,))
+		
+		insert_at.append((end, end))
+		insert_chars.append(CRLF)
+		start = end
+	
+	escaped[bump] += 64
+	escaped = _yInsert(escaped, numpy.concatenate(insert_at), numpy.concatenate(insert_chars))
+	postfile.write(escaped.tobytes())
+	
+	return CRC32(data)
+
+def _yInsert(array, positions, values):
+	'numpy.insert() for positions that are already in order'
+	# Inserts at the same position stay in the order they were given, so a line
+	# ending and the next line's escape come out the right way around.
+	positions = positions + numpy.arange(len(positions))
+	inserted = numpy.empty(len(array) + len(positions), dtype=numpy.uint8)
+	keep = numpy.ones(len(inserted), dtype=bool)
+	keep[positions] = False
+	inserted[keep] = array
+	inserted[positions] = values
+	return inserted
+
 # ---------------------------------------------------------------------------
 
 YSPLIT_RE = re.compile(r'(\S+)=')
@@ -141,6 +349,8 @@ def yEncMode():
 		return 'yenc-fred'
 	elif HAVE_YENC:
 		return 'yenc-vanilla'
+	elif HAVE_NUMPY:
+		return 'python-numpy'
 	elif HAVE_PSYCO:
 		return 'python-psyco'
 	else:
@@ -159,20 +369,31 @@ def SafeFilename(filename):
 	return safe_filename
 
 # ---------------------------------------------------------------------------
-# Use the _yenc C module if it's available. If not, try to use psyco to speed
-# up part encoding 25-30%.
+# Use the _yenc C module if it's available. If not, try to use NumPy to encode
+# whole parts at once, and failing that try to use psyco to speed up part
+# encoding 25-30%.
 try:
 	import _yenc
 except ImportError:
 	try:
-		import psyco
+		import numpy
 	except ImportError:
-		pass
+		try:
+			import psyco
+		except ImportError:
+			pass
+		else:
+			HAVE_PSYCO = True
+			psyco.bind(yEncode_Python)
+			psyco.bind(yEncode_Stream)
+		yEncode = yEncode_Python
+		yEncodeInto = yEncode_Stream
 	else:
-		HAVE_PSYCO = True
-		psyco.bind(yEncode_Python)
-	yEncode = yEncode_Python
+		HAVE_NUMPY = True
+		yEncode = yEncode_NumPy
+		yEncodeInto = yEncodeInto_Writer
 else:
 	HAVE_YENC = True
 	HAVE_YENC_FRED = ('Freddie mod' in _yenc.__doc__)
 	yEncode = yEncode_C
+	yEncodeInto = yEncodeInto_Writer